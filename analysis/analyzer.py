@@ -5,6 +5,7 @@ from datetime import datetime
 from enum import Enum
 from loguru import logger
 from queue import Queue
+from repository.apps import most_installed_first
 from threading import Thread, Timer
 
 import abc
@@ -59,7 +60,10 @@ class AppAnalyzerThread:
 			event = self.events.get()
 
 			if event.type == ThreadEventType.ANALYZE_APPS:
-				for app in filter(lambda a: not a.is_system_app(), self.application_repo.apps.values()):
+				updated_apps = set()
+
+				# Apps installed on the most devices are analyzed first, since their scores affect the most devices
+				for app in most_installed_first(filter(lambda a: not a.is_system_app(), self.application_repo.snapshot().apps.values())):
 					sources = {}
 
 					for analyzer in self.analyzers:
@@ -75,9 +79,13 @@ class AppAnalyzerThread:
 
 					# Avoid updating the risk score if analysis couldn't be completed by any class
 					if len(sources) > 0:
-						self.application_repo.update_risk_score_from_sources(app, sources)
+						if self.application_repo.update_risk_score_from_sources(app, sources):
+							updated_apps.add(app.unique_id())
 
-				self.devices_repo.update_risk_scores_from_repo(self.application_repo)
+				# Devices are scored from the published app risk scores
+				self.application_repo.publish()
+				# Only devices with apps that got a new risk score need to be updated
+				self.devices_repo.update_risk_scores_from_repo(self.application_repo, updated_apps)
 
 				next_analysis_timer = Timer(configs.main.analysis.timer, lambda:
 					self.events.put(ThreadEvent(ThreadEventType.ANALYZE_APPS)))
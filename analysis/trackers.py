@@ -1,13 +1,17 @@
 # Copyright (c) 2024 Hannes Mann, Alexander Wigren
 # See LICENSE for details
 
-import requests
+import network
 import configs
 
 from analysis.analyzer import AppAnalyzer
 from model.app import OperatingSystem
 
 class TrackerAnalyzer(AppAnalyzer):
+	def __init__(self):
+		# Optional repository.exodus.ExodusRepository, the tracker catalog is downloaded for every report if not set
+		self.mirror = None
+
 	def name(self):
 		return 'Exodus Privacy Trackers'
 
@@ -33,9 +37,11 @@ class TrackerAnalyzer(AppAnalyzer):
 	# This method return a detailed list of all the trackers present in the application.
 	def tracker_report(self, app):
 
-		trackerBlob = requests.get(f'https://reports.exodus-privacy.eu.org/api/trackers', headers = {'Authorization': f'Token {configs.secrets.api.exodus}'})
-
-		trackerData = trackerBlob.json()
+		if self.mirror and self.mirror.trackers():
+			trackerData = {'trackers': self.mirror.trackers()}
+		else:
+			trackerBlob = network.get(f'https://reports.exodus-privacy.eu.org/api/trackers', headers = {'Authorization': f'Token {configs.secrets.api.exodus}'})
+			trackerData = trackerBlob.json()
 
 		trackerlist = app.trackers
 
@@ -4,30 +4,38 @@
 from bottle import response
 from api.error import *
 
+import network
+
 def define_fetch_routes(app, repositories):
 	@app.route("/", method="GET")
 	@app.route("/api/overview", method="GET")
 	def overview():
+		# Counts and the materialized organization scores are read without building snapshots,
+		# so polling the overview during an import doesn't copy every app and device
 		return make_success({
 			"overview": {
-				"apps": len(repositories.apps.apps),
-				"devices": len(repositories.devices.devices),
-				"risk_score": repositories.devices.combine_scores_for_organization()
+				"apps": repositories.apps.app_count(),
+				"devices": repositories.devices.device_count(),
+				"risk_score": repositories.devices.organization_score(),
+				"risk_score_by_os": repositories.devices.organization_scores_by("os"),
+				"risk_score_by_ownership": repositories.devices.organization_scores_by("ownership")
 			}
 		})
 
 	@app.route("/api/apps", method="GET")
 	def list_apps():
+		apps = repositories.apps.snapshot()
 		return make_success({
-			"count": len(repositories.apps.apps),
-			"apps": list(map(lambda a: a.__dict__, repositories.apps.apps.values()))
+			"count": len(apps.apps),
+			"apps": [app.to_dict() for app in apps.apps.values()]
 		})
 
 	@app.route("/api/devices", method="GET")
 	def list_devices():
+		devices = repositories.devices.snapshot()
 		return make_success({
-			"count": len(repositories.devices.devices),
-			"devices": list(map(lambda d: d.__dict__, repositories.devices.devices.values()))
+			"count": len(devices.devices),
+			"devices": [device.to_dict() for device in devices.devices.values()]
 		})
 
 	@app.route("/api/app/<os>/<id>", method="GET")
@@ -38,8 +46,9 @@ def define_fetch_routes(app, repositories):
 		elif os == "ios":
 			unique_id = f"{id}_IOS"
 
-		if unique_id in repositories.apps.apps:
-			risk_score = repositories.apps.risk_scores.get(unique_id)
+		app = repositories.apps.app(unique_id)
+		if app:
+			risk_score = repositories.apps.risk_score(unique_id)
 			risk_score_response = None
 
 			if risk_score:
@@ -49,7 +58,7 @@ def define_fetch_routes(app, repositories):
 				}
 
 			return make_success({
-				"data": repositories.apps.apps[unique_id].__dict__,
+				"data": app.to_dict(),
 				"risk_score": risk_score_response
 			})
 
@@ -58,11 +67,18 @@ def define_fetch_routes(app, repositories):
 
 	@app.route("/api/device/<id>", method="GET")
 	def get_device_from_id(id):
-		if id in repositories.devices.devices:
+		device = repositories.devices.device(id)
+		if device:
 			return make_success({
-				"data": repositories.devices.devices[id].__dict__,
-				"risk_score": repositories.devices.risk_scores.get(id)
+				"data": device.to_dict(),
+				"risk_score": repositories.devices.risk_score(id)
 			})
 
 		response.status = 404
 		return make_error(ERROR_NOT_FOUND)
+
+	@app.route("/api/network", method="GET")
+	def network_statistics():
+		return make_success({
+			"hosts": network.client.host_statistics()
+		})
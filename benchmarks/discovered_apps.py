@@ -0,0 +1,55 @@
+# Copyright (c) 2024 Hannes Mann, Alexander Wigren
+# See LICENSE for details
+
+"""
+Measures Device.update_discovered_apps for devices with thousands of apps
+
+Importers add every detected app of a device in one call. is_app_installed sorts a copy of the handles
+the first time a device is queried, so the first and later lookups are timed separately
+
+Run from the root of the repository: python benchmarks/discovered_apps.py [--devices 100]
+"""
+
+from argparse import ArgumentParser
+from os import path
+from time import perf_counter
+
+import sys
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from model.app import OperatingSystem
+from model.mdm import Device, DeviceOwnership
+
+if __name__ == "__main__":
+	parser = ArgumentParser(description="Time to add discovered apps to devices")
+	parser.add_argument("--devices", type=int, default=100)
+	args = parser.parse_args()
+
+	for app_count in (500, 2000, 5000):
+		# Every app is reported twice, duplicates are skipped
+		apps = [f"com.example.app{i}" for i in range(app_count)] * 2
+		devices = [Device(f"device{i}", f"Device_{i}", OperatingSystem.ANDROID, DeviceOwnership.CORPORATE_OWNED) for i in range(args.devices)]
+
+		start = perf_counter()
+		for device in devices:
+			device.update_discovered_apps(apps)
+		batch = perf_counter() - start
+
+		start = perf_counter()
+		for device in devices:
+			device.is_app_installed(apps[0])
+		first_lookup = perf_counter() - start
+
+		start = perf_counter()
+		for device in devices:
+			for app in apps[:app_count]:
+				device.is_app_installed(app)
+		lookups = perf_counter() - start
+
+		assert all(len(device.discovered_apps) == app_count for device in devices)
+		print(
+			f"{app_count} apps: {batch / args.devices * 1000:.2f} ms per device in one call, "
+			f"{first_lookup / args.devices * 1000:.2f} ms for the first is_app_installed, "
+			f"{lookups / args.devices / app_count * 1e9:.0f} ns for later calls"
+		)
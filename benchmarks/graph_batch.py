@@ -0,0 +1,138 @@
+# Copyright (c) 2024 Hannes Mann, Alexander Wigren
+# See LICENSE for details
+
+"""
+Compares IntuneImporter.fetch_devices with sending one request per page, using a local stand-in for Microsoft Graph
+
+The stand-in serves managedDevices in pages of 100 and two pages of 50 detected apps for each device.
+Every response is sent after a fixed latency and every 10th $batch request is throttled with a 429.
+Both runs wait for the Graph rate limit in config.toml, which --calls can change.
+
+Run from the root of the repository: python benchmarks/graph_batch.py [--devices 1000] [--latency 0.05] [--calls N]
+"""
+
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from loguru import logger
+from munch import Munch
+from os import path
+from threading import Thread
+from time import perf_counter, sleep
+
+import json
+import re
+import sys
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import configs
+import importers.apps.limiter as limiter
+import importers.devices.intune as intune
+
+class StandInGraph(BaseHTTPRequestHandler):
+	protocol_version = "HTTP/1.1"
+	device_count = 0
+	latency = 0.0
+	batches = 0
+
+	def log_message(self, *args):
+		pass
+
+	def send_json(self, status, body, headers={}):
+		content = json.dumps(body).encode("utf-8")
+		self.send_response(status)
+		for header, value in headers.items():
+			self.send_header(header, value)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(content)))
+		self.end_headers()
+		self.wfile.write(content)
+
+	def detected_apps(self, url):
+		device_id = re.search("managedDevices/([^/]+)/detectedApps", url).group(1)
+		skip = 50 if "skip" in url else 0
+		body = {"value": [{"displayName": f"com.example.{device_id}.app{i}"} for i in range(skip, skip + 50)]}
+		if not skip:
+			body["@odata.nextLink"] = f"{intune.graph_url}/deviceManagement/managedDevices/{device_id}/detectedApps?skip=50"
+		return body
+
+	def do_GET(self):
+		sleep(self.latency)
+		if "detectedApps" in self.path:
+			return self.send_json(200, self.detected_apps(self.path))
+
+		page = int(self.path.split("page=")[1]) if "page=" in self.path else 0
+		devices = range(page * 100, min((page + 1) * 100, self.device_count))
+		body = {"value": [
+			{"id": f"device{i}", "operatingSystem": "Android", "deviceName": f"Device {i}", "managedDeviceOwnerType": "company"}
+			for i in devices
+		]}
+		if devices.stop < self.device_count:
+			body["@odata.nextLink"] = f"{intune.graph_url}/deviceManagement/managedDevices?page={page + 1}"
+		self.send_json(200, body)
+
+	def do_POST(self):
+		requests = json.loads(self.rfile.read(int(self.headers["Content-Length"])))["requests"]
+		StandInGraph.batches += 1
+		sleep(self.latency)
+		if StandInGraph.batches % 10 == 0:
+			return self.send_json(429, {}, {"Retry-After": "0"})
+
+		self.send_json(200, {"responses": [
+			{"id": request["id"], "status": 200, "body": self.detected_apps(request["url"])}
+			for request in requests
+		]})
+
+def fetch_sequentially(importer):
+	"""Detected apps of each device are downloaded one page at a time, the way fetch_devices worked before batching"""
+	devices = {}
+	for device in importer.intune_items("deviceManagement/managedDevices"):
+		devices[device["id"]] = list(importer.intune_items(f"deviceManagement/managedDevices/{device['id']}/detectedApps"))
+	return devices
+
+def measure(fetch):
+	"""Returns the number of devices returned by fetch, the time it took and the number of requests"""
+
+	# Every run starts with a full rate limit bucket
+	limiter.buckets.clear()
+	importer = intune.IntuneImporter()
+	importer.token = "token"
+
+	start = perf_counter()
+	devices = fetch(importer)
+	elapsed = perf_counter() - start
+
+	assert len(devices) == StandInGraph.device_count and all(len(apps) == 100 for apps in devices.values())
+	return len(devices), elapsed, importer.request_counter
+
+if __name__ == "__main__":
+	parser = ArgumentParser(description="Devices per second from a stand-in Graph server")
+	parser.add_argument("--devices", type=int, default=1000)
+	parser.add_argument("--latency", type=float, default=0.05, help="Seconds before each response")
+	parser.add_argument("--calls", type=int, help="Requests per rate limit period, defaults to the Graph limit in config.toml")
+	args = parser.parse_args()
+
+	logger.remove()
+	configs.load("config.toml", "secrets.toml")
+	# Only the stand-in is limited, at the configured Graph rate limit
+	rate_limit = configs.main.importers.rate_limits["127.0.0.1"] = Munch(configs.main.importers.rate_limits["graph.microsoft.com"])
+	if args.calls:
+		rate_limit.calls = args.calls
+	print(f"Rate limit: {rate_limit.calls} requests per {rate_limit.period} s, {args.latency * 1000:.0f} ms latency")
+
+	StandInGraph.device_count = args.devices
+	StandInGraph.latency = args.latency
+	server = ThreadingHTTPServer(("127.0.0.1", 0), StandInGraph)
+	Thread(target=server.serve_forever, daemon=True).start()
+	intune.graph_url = f"http://127.0.0.1:{server.server_port}/beta"
+
+	runs = {
+		"One request per page": fetch_sequentially,
+		"fetch_devices with $batch": lambda importer: {id: device.discovered_apps for id, device in importer.fetch_devices().items()}
+	}
+	times = []
+	for name, fetch in runs.items():
+		count, elapsed, requests = measure(fetch)
+		times.append(elapsed)
+		print(f"{name}: {count} devices with 100 apps each in {elapsed:.1f} s ({count / elapsed:.0f} devices/s, {requests} HTTP requests)")
+	print(f"Speedup: {times[0] / times[1]:.1f}x")
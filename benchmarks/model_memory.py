@@ -0,0 +1,90 @@
+# Copyright (c) 2024 Hannes Mann, Alexander Wigren
+# See LICENSE for details
+
+"""
+Measures the memory used by Application and Device objects
+
+Run from the root of the repository: python benchmarks/model_memory.py [--apps 100000] [--devices 10000]
+"""
+
+from argparse import ArgumentParser
+from os import path
+
+import gc
+import random
+import sys
+import tracemalloc
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+from model.app import Application, OperatingSystem
+from model.mdm import Device, DeviceOwnership
+
+class ListApplication:
+	"""Application as stored before __slots__: permissions and trackers in lists, attributes in a __dict__"""
+
+	def __init__(self, id, os, name=None, permissions=None, trackers=None, store_page_url=None, privacy_policy_url=None, other_os_id=None):
+		self.id = id
+		self.os = os
+		self.name = name
+		self.permissions = list(set(permissions)) if permissions else None
+		self.trackers = list(set(trackers)) if trackers else None
+		self.store_page_url = store_page_url
+		self.privacy_policy_url = privacy_policy_url
+		self.other_os_id = other_os_id
+
+class ListDevice:
+	"""Device as stored before __slots__: discovered package IDs in a list, attributes in a __dict__"""
+
+	def __init__(self, id, name, os, ownership):
+		self.id = id
+		self.name = name
+		self.os = os
+		self.ownership = ownership
+		self.discovered_apps = []
+
+	def update_discovered_apps(self, apps):
+		self.discovered_apps = list(dict.fromkeys(apps))
+
+def create_device(device_class, i, apps):
+	device = device_class(f"device{i}", f"Device_{i}", OperatingSystem.ANDROID, DeviceOwnership.CORPORATE_OWNED)
+	device.update_discovered_apps(apps)
+	return device
+
+def measure(create):
+	"""Returns the objects returned by create and the number of bytes allocated while creating them"""
+	gc.collect()
+	tracemalloc.start()
+	objects = create()
+	gc.collect()
+	size = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	return objects, size
+
+if __name__ == "__main__":
+	parser = ArgumentParser(description="Memory used by apps and devices")
+	parser.add_argument("--apps", type=int, default=100000)
+	parser.add_argument("--devices", type=int, default=10000)
+	parser.add_argument("--apps-per-device", type=int, default=200)
+	args = parser.parse_args()
+
+	rng = random.Random(1)
+	permissions = [f"android.permission.PERMISSION_{i}" for i in range(150)]
+	trackers = [str(i) for i in range(400)]
+	app_permissions = [rng.sample(permissions, 15) for _ in range(args.apps)]
+	app_trackers = [rng.sample(trackers, 5) for _ in range(args.apps)]
+	app_ids = [f"com.example.app{i}" for i in range(args.apps)]
+	device_apps = [rng.sample(app_ids[:5000], args.apps_per_device) for _ in range(args.devices)]
+
+	for app_class in (ListApplication, Application):
+		apps, size = measure(lambda: [
+			app_class(app_ids[i], OperatingSystem.ANDROID, f"App {i}", app_permissions[i], app_trackers[i], f"https://example.com/{i}")
+			for i in range(args.apps)
+		])
+		print(f"{app_class.__name__}: {args.apps} apps with 15 permissions and 5 trackers, {size / 1e6:.1f} MB ({size / args.apps:.0f} bytes per app)")
+		del apps
+
+	for device_class in (ListDevice, Device):
+		devices, size = measure(lambda: [create_device(device_class, i, device_apps[i]) for i in range(args.devices)])
+		print(f"{device_class.__name__}: {args.devices} devices with {args.apps_per_device} apps, {size / 1e6:.1f} MB ({size / args.devices:.0f} bytes per device)")
+		del devices
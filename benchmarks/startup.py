@@ -0,0 +1,88 @@
+# Copyright (c) 2024 Hannes Mann, Alexander Wigren
+# See LICENSE for details
+
+"""
+Measures how long the repositories take to load a synthetic database at startup
+
+Run from the root of the repository: python benchmarks/startup.py [--apps 50000] [--devices 20000]
+"""
+
+from argparse import ArgumentParser
+from loguru import logger
+from os import path
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import random
+import sys
+
+sys.path.insert(0, path.dirname(path.dirname(path.abspath(__file__))))
+
+import configs
+
+from model.app import Application, OperatingSystem
+from model.mdm import Device, DeviceOwnership
+from repository.apps import ApplicationRepository
+from repository.database import create_database_engine
+from repository.devices import DevicesRepository
+from repository.migrations import migrate_database
+
+def create_database(engine, app_count, device_count):
+	rng = random.Random(1)
+	permissions = [f"android.permission.PERMISSION_{i}" for i in range(150)]
+	trackers = [str(i) for i in range(400)]
+
+	apps = ApplicationRepository(engine)
+	app_ids = []
+	for i in range(app_count):
+		os = OperatingSystem.ANDROID if i % 2 == 0 else OperatingSystem.IOS
+		app = Application(f"com.example.app{i}", os, f"App {i}", store_page_url=f"https://example.com/{i}")
+		if os == OperatingSystem.ANDROID:
+			app.permissions = rng.sample(permissions, 15)
+			app.trackers = rng.sample(trackers, 5)
+		apps.add_or_update_app(app)
+		apps.update_risk_score_from_sources(app, {"Android Permissions": rng.random(), "Exodus Privacy Trackers": rng.random()})
+		app_ids.append((app.id, os))
+	apps.publish()
+	apps.flush()
+
+	# Devices have the 1000 most common apps for their OS
+	common_app_ids = {os: [id for id, app_os in app_ids[:2000] if app_os == os] for os in (OperatingSystem.ANDROID, OperatingSystem.IOS)}
+
+	devices = DevicesRepository(engine)
+	for i in range(device_count):
+		os = OperatingSystem.ANDROID if i % 2 == 0 else OperatingSystem.IOS
+		device = Device(f"device{i}", f"Device_{i}", os, DeviceOwnership.CORPORATE_OWNED)
+		device.update_discovered_apps(rng.choice(common_app_ids[os]) for _ in range(50))
+		devices.add_or_replace_device(device)
+	devices.update_risk_scores_from_repo(apps)
+	devices.flush()
+
+if __name__ == "__main__":
+	parser = ArgumentParser(description="Startup time for a synthetic database")
+	parser.add_argument("--apps", type=int, default=50000)
+	parser.add_argument("--devices", type=int, default=20000)
+	args = parser.parse_args()
+
+	logger.remove()
+	configs.load("config.toml", "secrets.toml")
+
+	with TemporaryDirectory() as directory:
+		engine = create_database_engine(f"sqlite:///{path.join(directory, 'benchmark.db')}")
+		migrate_database(engine)
+
+		start = perf_counter()
+		create_database(engine, args.apps, args.devices)
+		print(f"Created database with {args.apps} apps and {args.devices} devices in {perf_counter() - start:.1f} s")
+
+		apps = ApplicationRepository(engine)
+		start = perf_counter()
+		apps.__enter__()
+		print(f"ApplicationRepository loaded {len(apps.apps)} apps in {perf_counter() - start:.2f} s")
+
+		devices = DevicesRepository(engine)
+		start = perf_counter()
+		devices.__enter__()
+		print(f"DevicesRepository loaded {len(devices.devices)} devices in {perf_counter() - start:.2f} s")
+
+		engine.dispose()
@@ -9,10 +9,12 @@ from loguru import logger
 
 main = Munch()
 secrets = Munch()
+# Incremented every time configs are loaded, used to invalidate values computed from configs
+version = 0
 
 def load(main_file, secrets_file):
 	"""Load configs and store in configs.main, configs.secrets"""
-	global main, secrets
+	global main, secrets, version
 
 	logger.info(f"Main config file: {main_file}")
 	logger.info(f"Secrets file: {secrets_file}")
@@ -27,6 +29,7 @@ def load(main_file, secrets_file):
 
 	main = munchify(toml.load(main_file))
 	secrets = munchify(toml.load(secrets_file))
+	version += 1
 
 	if not secrets.api.openai:
 		logger.warning("secrets.api.openai is not set. The GPT analyzer needs access to the OpenAI API to function.")
@@ -1,71 +1,147 @@
 # Copyright (c) 2024 Hannes Mann, Alexander Wigren
 # See LICENSE for details
 
+from enum import Enum
 from loguru import logger
-from importers.apps.importer import AppInfoImporter
+from queue import Queue
+from threading import Thread, Timer
+from importers.apps.importer import AppInfoImporter, AppNotFoundError
+from importers.apps.limiter import wait_for_host
 from model.app import OperatingSystem
-
-from ratelimit import limits, sleep_and_retry
+from repository.exodus import latest_report
 
 import configs
-import requests
+import network
+import traceback
+
+exodus_api_url = "https://reports.exodus-privacy.eu.org/api"
+
+def exodus_request(path):
+	"""Send a GET request to the Exodus Privacy API and return the JSON response"""
+
+	if not configs.secrets.api.exodus:
+		raise ValueError("configs.secrets.api.exodus not set")
+
+	url = f"{exodus_api_url}/{path}"
+	wait_for_host(url)
+	res = network.get(url, headers = {'Authorization': f'Token {configs.secrets.api.exodus}'})
+	if res.status_code != 200:
+		raise ValueError(f"Got {res.status_code} from Exodus")
+	return res.json()
 
 class ExodusImporter(AppInfoImporter):
+	def __init__(self):
+		# Optional repository.exodus.ExodusRepository, apps are looked up in Exodus directly if not set
+		self.mirror = None
+
 	def os(self):
 		return OperatingSystem.ANDROID
 
-	@sleep_and_retry
-	@limits(calls=30, period=1)
-	def import_info_for_app(self, app, repo):
-		if not configs.secrets.api.exodus:
-			raise ValueError("configs.secrets.api.exodus not set")
+	def needs_info_for_app(self, app):
+		return not app.permissions or not app.trackers
 
+	def import_info_for_app(self, app, repo):
 		# Already analyzed
 		if app.permissions and app.trackers:
 			return
 
-		# The Exodus API has occasionally given us trouble due to misconfigured caches on their end. Hopefully it keeps working.
-		# For demonstration purposes it is probably a good idea to use some pre-fetched JSON to avoid making live calls to the API
-		# in front of an audience.
-		versionBlob = requests.get(
-			f'https://reports.exodus-privacy.eu.org/api/search/{app.id}/details',
-			headers = {'Authorization': f'Token {configs.secrets.api.exodus}'}
-		)
-		data = versionBlob.json()
-
-		if versionBlob.status_code != 200:
-			logger.warning(f"Got {versionBlob.status_code} from Exodus")
-			return
-
-		# Not found
-		if len(data) == 0:
-			logger.warning(f"App {app.id} not found in Exodus Privacy database")
-			return
+		mirrored = self.mirror.report(app.id) if self.mirror else None
+		if mirrored:
+			if mirrored.version_code is None:
+				raise AppNotFoundError(f"App {app.id} not found in Exodus Privacy mirror")
+			report = mirrored._asdict()
+		else:
+			# The Exodus API has occasionally given us trouble due to misconfigured caches on their end. Hopefully it keeps working.
+			# For demonstration purposes it is probably a good idea to use some pre-fetched JSON to avoid making live calls to the API
+			# in front of an audience.
+			report = latest_report(exodus_request(f"search/{app.id}/details"))
+			if self.mirror:
+				self.mirror.store_report(app.id, None, report)
 
-		# The reports are unordered so we need to iterate over them to find the most recent version. The bigger the versionCode, the more recent it is.
-		# Note that the versionCode and versionName are different. The code is just an integer, while the name is the true versions like "460.0.0.34.89" as an example.
-		permissions = []
-		trackers = []
-		appName = ''
-		versionCode = 0
-		versionName = ''
-
-		for element in data:
-			if(int(element['version_code']) > versionCode):
-				appName = element['app_name']
-				versionCode = int(element['version_code'])
-				versionName = element['version_name']
-				permissions = element['permissions']
-				trackers = element['trackers']
+			# Not found
+			if not report:
+				raise AppNotFoundError(f"App {app.id} not found in Exodus Privacy database")
 
 		# Set the app attributes
-		app.name = appName
-		app.permissions = list(set(permissions))
-		logger.info(f"Got {len(app.permissions)} permissions for {app.id}")
-		app.trackers = list(set(trackers))
-		logger.info(f"Got {len(app.trackers)} trackers for {app.id}")
+		app.name = report["app_name"]
+		app.permissions = report["permissions"]
+		logger.info(f"Got {len(app.permissions or [])} permissions for {app.id}")
+		app.trackers = report["trackers"]
+		logger.info(f"Got {len(app.trackers or [])} trackers for {app.id}")
 
 		# Add to repo and return
 		repo.add_or_update_app(app)
-		return#
 
+class ThreadEventType(Enum):
+	STOP_THREAD = 0
+	SYNC_MIRROR = 1
+
+class ThreadEvent:
+	def __init__(self, type, data=None):
+		self.type = type
+		self.data = data
+
+class ExodusMirrorThread:
+	"""Periodically copies the tracker catalog and reports for Android apps in ApplicationRepository to ExodusRepository"""
+
+	def __init__(self, exodus_repo, application_repo):
+		self.exodus_repo = exodus_repo
+		self.application_repo = application_repo
+
+		self.events = Queue()
+		self.events.put(ThreadEvent(ThreadEventType.SYNC_MIRROR))
+
+		self.thread = Thread(target=self.mirror_thread, daemon=True)
+		self.thread.start()
+
+	def sync(self):
+		self.exodus_repo.replace_trackers(exodus_request("trackers")["trackers"])
+
+		# The application list is used to find reports that have changed since the last sync
+		report_updated_at = {a["handle"]: a["report_updated_at"] for a in exodus_request("applications")["applications"]}
+		mirrored_versions = self.exodus_repo.report_versions()
+
+		handles = {
+			app.id for app in self.application_repo.snapshot().apps.values()
+			if app.os == OperatingSystem.ANDROID and not app.is_system_app()
+		}
+
+		downloaded = 0
+		for handle in handles:
+			if handle not in report_updated_at:
+				# Remember that Exodus doesn't have the package so the importer doesn't have to ask
+				if handle not in mirrored_versions:
+					self.exodus_repo.store_report(handle, None, None)
+			elif handle not in mirrored_versions or mirrored_versions[handle] != report_updated_at[handle]:
+				self.exodus_repo.store_report(
+					handle,
+					report_updated_at[handle],
+					latest_report(exodus_request(f"search/{handle}/details"))
+				)
+				downloaded += 1
+
+		logger.info(f"Exodus Privacy mirror is up to date for {len(handles)} apps ({downloaded} reports downloaded)")
+
+	# Thread to periodically update the mirror
+	def mirror_thread(self):
+		logger.success(f"Exodus Privacy mirror thread started and waiting for events")
+
+		while True:
+			event = self.events.get()
+
+			if event.type == ThreadEventType.SYNC_MIRROR:
+				try:
+					self.sync()
+				except Exception as e:
+					if configs.main.server.debug:
+						logger.warning(f"Exodus Privacy mirror sync failed: {traceback.format_exc()}")
+					else:
+						logger.warning(f"Exodus Privacy mirror sync failed: {e}")
+
+				next_sync_timer = Timer(configs.main.importers.exodus.sync_timer, lambda:
+					self.events.put(ThreadEvent(ThreadEventType.SYNC_MIRROR)))
+				next_sync_timer.daemon = True
+				next_sync_timer.start()
+
+			elif event.type == ThreadEventType.STOP_THREAD:
+				return
@@ -1,7 +1,9 @@
 # Copyright (c) 2024 Hannes Mann, Alexander Wigren
 # See LICENSE for details
 
+from concurrent.futures import ThreadPoolExecutor, wait
 from enum import Enum
+from functools import partial
 from loguru import logger
 from queue import Queue
 from threading import Thread, Timer
@@ -11,6 +13,13 @@ import copy
 import configs
 import traceback
 
+class AppNotFoundError(Exception):
+	"""
+	Raised by AppInfoImporter when the source has no information about an app
+	The app is looked up again after a delay that grows with every failure
+	"""
+	pass
+
 class AppInfoImporter(abc.ABC):
 	"""Represents a source of additional application data (permissions, trackers, etc)"""
 
@@ -19,6 +28,20 @@ class AppInfoImporter(abc.ABC):
 		"""Get the operating system that this importer provides application info for"""
 		pass
 
+	def needs_info_for_app(self, app):
+		"""
+		Returns true if this importer can provide more information for the app
+		Apps for which this returns false are not passed to import_info_for_app
+		"""
+		return not app.is_complete_app()
+
+	def prefetch(self, apps):
+		"""
+		Called with all apps that will be passed to import_info_for_app during a scan
+		Importers can override this to fetch information for many apps at once
+		"""
+		pass
+
 	@abc.abstractmethod
 	def	import_info_for_app(self, app, repo):
 		"""
@@ -47,12 +70,79 @@ class AppInfoImporterThread:
 			logger.info(f"Adding app info importers: {' '.join([type(i).__name__ for i in default_importers])}")
 			self.importers = default_importers
 
+		# The repository keeps track of which apps each importer still needs to check
+		for importer in self.importers:
+			self.application_repo.add_work_set(importer, partial(self.needs_import, importer))
+
+		# Each importer checks several apps at the same time, requests are limited per host by importers.apps.limiter
+		# Importers have separate workers so that a slow source doesn't hold up the others
+		self.executors = {
+			importer: ThreadPoolExecutor(configs.main.importers.workers, thread_name_prefix=type(importer).__name__)
+			for importer in self.importers
+		}
+		# Importers are scanned at the same time, each waiting for its own workers
+		self.scanners = ThreadPoolExecutor(max(len(self.importers), 1), thread_name_prefix="AppInfoScanner")
+
 		self.events = Queue()
 		self.events.put(ThreadEvent(ThreadEventType.SCAN_APPS))
 
 		self.thread = Thread(target=self.import_thread, daemon=True)
 		self.thread.start()
 
+	def needs_import(self, importer, app):
+		# Don't check system apps or apps that we already have all info available for
+		return app.os == importer.os() and not app.is_system_app() and importer.needs_info_for_app(app)
+
+	def import_info_for_app(self, importer, app):
+		try:
+			logger.info(f"{type(importer).__name__} checking {app.id}")
+			importer.import_info_for_app(copy.deepcopy(app), self.application_repo)
+			self.application_repo.clear_app_not_found(app, type(importer).__name__)
+		except AppNotFoundError as e:
+			retry_at = self.application_repo.record_app_not_found(app, type(importer).__name__)
+			logger.warning(f"{e}, {type(importer).__name__} will check {app.id} again at {retry_at:%Y-%m-%d %H:%M}")
+		except Exception as e:
+			if configs.main.server.debug:
+				logger.warning(f"Importer {type(importer).__name__} failed for {app.id}: {traceback.format_exc()}")
+			else:
+				logger.warning(f"Importer {type(importer).__name__} failed for {app.id}: {e}")
+
+	def log_failures(self, futures, importers):
+		"""
+		Wait for futures and log the exceptions raised by any of them
+
+		:param importers: Importer that each future belongs to, in the same order as futures
+		"""
+		wait(futures)
+		for future, importer in zip(futures, importers):
+			e = future.exception()
+			if e:
+				if configs.main.server.debug:
+					logger.warning(f"Importer {type(importer).__name__} failed to scan apps: {''.join(traceback.format_exception(e))}")
+				else:
+					logger.warning(f"Importer {type(importer).__name__} failed to scan apps: {e}")
+
+	def scan_apps(self, importer):
+		# Skip apps that this importer couldn't find during a previous scan until their delay has passed
+		pending_apps = [
+			app for app in self.application_repo.work_set(importer)
+			if not self.application_repo.is_app_import_delayed(app, type(importer).__name__)
+		]
+		if not pending_apps:
+			return
+
+		logger.info(f"{type(importer).__name__} has {len(pending_apps)} apps to check")
+		try:
+			importer.prefetch(pending_apps)
+		except Exception as e:
+			# Apps are still checked one by one if prefetching fails
+			logger.warning(f"Importer {type(importer).__name__} failed to prefetch apps: {e}")
+
+		futures = [self.executors[importer].submit(self.import_info_for_app, importer, app) for app in pending_apps]
+		self.log_failures(futures, [importer] * len(futures))
+		# Readers see the apps updated during this scan at once
+		self.application_repo.publish()
+
 	# Thread to periodically import data from app stores and related sources
 	def import_thread(self):
 		logger.success(f"App info importer thread started and waiting for events")
@@ -61,18 +151,8 @@ class AppInfoImporterThread:
 			event = self.events.get()
 
 			if event.type == ThreadEventType.SCAN_APPS:
-				for app in self.application_repo.apps.values():
-					# Don't check system apps or apps that we already have all info available for
-					if not app.is_complete_app() and not app.is_system_app():
-						for importer in filter(lambda i: i.os() == app.os, self.importers):
-							try:
-								logger.info(f"{type(importer).__name__} checking {app.id}")
-								importer.import_info_for_app(copy.deepcopy(app), self.application_repo)
-							except Exception as e:
-								if configs.main.server.debug:
-									logger.warning(f"Importer {type(importer).__name__} failed for {app.id}: {traceback.format_exc()}")
-								else:
-									logger.warning(f"Importer {type(importer).__name__} failed for {app.id}: {e}")
+				# Wait for all importers to finish before scheduling the next scan
+				self.log_failures([self.scanners.submit(self.scan_apps, importer) for importer in self.importers], self.importers)
 
 				next_scan_timer = Timer(configs.main.importers.timer, lambda:
 					self.events.put(ThreadEvent(ThreadEventType.SCAN_APPS)))
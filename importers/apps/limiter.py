@@ -0,0 +1,68 @@
+# Copyright (c) 2024 Hannes Mann, Alexander Wigren
+# See LICENSE for details
+
+from threading import Lock
+from time import monotonic, sleep
+from urllib.parse import urlparse
+
+import configs
+
+class TokenBucket:
+	"""Allows a number of calls per period, with bursts of up to the same number of calls"""
+
+	def __init__(self, calls, period):
+		"""
+		:param calls: Number of calls allowed per period
+		:param period: Length of the period in seconds
+		"""
+		self.capacity = calls
+		self.rate = calls / period
+
+		self.tokens = calls
+		self.updated = monotonic()
+		self.lock = Lock()
+
+	def acquire(self, tokens=1):
+		"""
+		Blocks the calling thread until a call is allowed
+
+		:param tokens: Number of calls to take at once, for example the requests in a batch request
+		More tokens than the bucket can hold are limited to its capacity, so large batches wait for a full bucket
+		"""
+
+		tokens = min(tokens, self.capacity)
+		while True:
+			with self.lock:
+				now = monotonic()
+				self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+				self.updated = now
+
+				if self.tokens >= tokens:
+					self.tokens -= tokens
+					return
+
+				delay = (tokens - self.tokens) / self.rate
+
+			# Sleep without holding the lock so that other threads can check the bucket
+			sleep(delay)
+
+# Token bucket for each host, created from configs.main.importers.rate_limits when first used
+buckets = {}
+buckets_lock = Lock()
+
+def bucket_for_host(host):
+	with buckets_lock:
+		if host not in buckets:
+			rate_limits = configs.main.importers.rate_limits
+			rate_limit = rate_limits.get(host, rate_limits.default)
+			buckets[host] = TokenBucket(rate_limit.calls, rate_limit.period)
+		return buckets[host]
+
+def wait_for_host(url, requests=1):
+	"""
+	Blocks the calling thread until a request to the host of url is allowed
+	Requests to different hosts are limited separately, so importers for different sources don't wait for each other
+
+	:param requests: Number of requests that are sent at once, for example in a batch request
+	"""
+	bucket_for_host(urlparse(url).hostname).acquire(requests)
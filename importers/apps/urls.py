@@ -2,35 +2,40 @@
 # See LICENSE for details
 
 from loguru import logger
-from importers.apps.importer import AppInfoImporter
+from importers.apps.importer import AppInfoImporter, AppNotFoundError
+from importers.apps.limiter import wait_for_host
 from model.app import OperatingSystem
-from ratelimit import limits, sleep_and_retry
 from bs4 import BeautifulSoup
+from threading import Lock
 
-import requests
+import configs
+import network
 
 language_header = {"Accept-Language": "en-US,en"}
 
 def verify_url_is_reachable(url):
-	try:
-		res = requests.get(url, headers=language_header)
-		return res.status_code == 200
-	except:
+	"""
+	Returns false if the page doesn't exist (404)
+	Other failures, such as timeouts or 429/5xx responses after all retries, are raised instead,
+	so that a temporary problem isn't mistaken for a missing app
+	"""
+	res = network.cached_get(url, wait_for_host, headers=language_header)
+	if res.status_code == 404:
 		return False
+	res.raise_for_status()
+	return True
 
-@sleep_and_retry
-@limits(calls=1, period=1)
 def find_printable_privacy_policy_url(url):
 	"""Attempts to find the printable version of a privacy policy through various heuristics"""
 
 	# Check if there is a printable version (found on facebook.com)
-	res_current = requests.get(url, headers=language_header)
+	res_current = network.cached_get(url, wait_for_host, headers=language_header)
 
 	page = BeautifulSoup(res_current.text, "html.parser")
 	for link in page.find_all("a"):
 		text = link.get_text(strip=True).lower()
 		if "print" in text:
-			res_printable = requests.get(res_current.url.split("?")[0].strip("/ ") + "/printable", headers=language_header)
+			res_printable = network.cached_get(res_current.url.split("?")[0].strip("/ ") + "/printable", wait_for_host, headers=language_header)
 			if res_current.text != res_printable.text and res_printable.status_code == 200:
 				return res_printable.url.strip("/ ")
 
@@ -46,24 +51,59 @@ def find_printable_privacy_policy_url(url):
 class AppStoreImporter(AppInfoImporter):
 	"""Imports name, store page URL and privacy policy URL from iTunes Search API"""
 
+	def __init__(self):
+		# Lowercase bundle ID to iTunes result (or None if not found) from the last prefetch
+		self.prefetched_results = {}
+		self.lock = Lock()
+
 	def	os(self):
 		return OperatingSystem.IOS
 
-	# iTunes Search API is limited to 20 calls per minute
-	@sleep_and_retry
-	@limits(calls=20, period=60)
+	# iTunes Search API is limited to 20 calls per minute (see configs.main.importers.rate_limits)
+	def lookup_itunes_information(self, bundle_ids):
+		"""Returns a dictionary of lowercase bundle ID to iTunes result for the bundle IDs that were found"""
+
+		# The lookup endpoint accepts a comma-separated list of bundle IDs
+		url = f"https://itunes.apple.com/lookup?bundleId={','.join(bundle_ids)}"
+		wait_for_host(url)
+		res = network.get(url, headers=language_header).json()
+		return {result["bundleId"].lower(): result for result in res["results"] if result.get("bundleId")}
+
+	def prefetch(self, apps):
+		"""Look up name and store page URL for many apps with one request per batch"""
+
+		bundle_ids = [app.id for app in apps if not app.name or not app.store_page_url]
+		prefetched_results = {}
+
+		batch_size = configs.main.importers.itunes_batch_size
+		for i in range(0, len(bundle_ids), batch_size):
+			batch = bundle_ids[i:i + batch_size]
+			results = self.lookup_itunes_information(batch)
+			for bundle_id in batch:
+				prefetched_results[bundle_id.lower()] = results.get(bundle_id.lower())
+
+		with self.lock:
+			self.prefetched_results = prefetched_results
+
+		logger.info(f"Looked up {len(bundle_ids)} apps in {-(-len(bundle_ids) // batch_size)} iTunes requests")
+
 	def import_itunes_information(self, app):
-		res = requests.get(f"https://itunes.apple.com/lookup?bundleId={app.id}", headers=language_header).json()
-		# TODO: if res["resultCount"] == 0 => remove app
-		if res["resultCount"] > 0 and res["results"][0]:
-			app.store_page_url = res["results"][0]["trackViewUrl"]
-			app.name = res["results"][0]["trackName"]
+		with self.lock:
+			prefetched = app.id.lower() in self.prefetched_results
+			result = self.prefetched_results.pop(app.id.lower(), None)
+
+		# Apps that weren't prefetched are looked up on their own
+		if not prefetched:
+			result = self.lookup_itunes_information([app.id]).get(app.id.lower())
+
+		if not result:
+			raise AppNotFoundError(f"App {app.id} not found in iTunes Search API")
+		app.store_page_url = result["trackViewUrl"]
+		app.name = result["trackName"]
 
 	# Since we are fetching from the App Store, limit to a low amount of requests
-	@sleep_and_retry
-	@limits(calls=1, period=5)
 	def get_privacy_policy_url(self, app):
-		res = requests.get(app.store_page_url, headers=language_header).text
+		res = network.cached_get(app.store_page_url, wait_for_host, headers=language_header).text
 		page = BeautifulSoup(res, "html.parser")
 		for link in page.find_all("a"):
 			text = link.get_text(strip=True).lower()
@@ -71,6 +111,9 @@ class AppStoreImporter(AppInfoImporter):
 				return find_printable_privacy_policy_url(link.get("href"))
 		return None
 
+	def needs_info_for_app(self, app):
+		return not app.name or not app.store_page_url or not app.privacy_policy_url
+
 	def	import_info_for_app(self, app, repo):
 		if not app.name or not app.store_page_url:
 			self.import_itunes_information(app)
@@ -92,26 +135,27 @@ class PlayStoreImporter(AppInfoImporter):
 		return OperatingSystem.ANDROID
 
 	# Since we are fetching from the Play Store, limit to a low amount of requests
-	@sleep_and_retry
-	@limits(calls=1, period=5)
 	def import_name(self, app):
-		res = requests.get(f"https://play.google.com/store/apps/details?id={app.id}", headers=language_header).text
+		url = f"https://play.google.com/store/apps/details?id={app.id}"
+		res = network.cached_get(url, wait_for_host, headers=language_header).text
 		page = BeautifulSoup(res, "html.parser")
 		element = page.find("h1", itemprop="name")
 		if element:
 			return element.text
 		return None
 
-	@sleep_and_retry
-	@limits(calls=1, period=5)
 	def import_privacy_policy_url(self, app):
-		res = requests.get(f"https://play.google.com/store/apps/datasafety?id={app.id}", headers=language_header).text
+		url = f"https://play.google.com/store/apps/datasafety?id={app.id}"
+		res = network.cached_get(url, wait_for_host, headers=language_header).text
 		page = BeautifulSoup(res, "html.parser")
 		for link in page.find_all("a"):
 			if link.get_text(strip=True).lower() == "privacy policy" and "developer" in link.parent.get_text(strip=True).lower():
 				return find_printable_privacy_policy_url(link.get("href"))
 		return None
 
+	def needs_info_for_app(self, app):
+		return not app.name or not app.store_page_url or not app.privacy_policy_url
+
 	def	import_info_for_app(self, app, repo):
 		if not app.name or not app.store_page_url:
 			# The Play Store URL is predictable based on the app ID
@@ -122,7 +166,7 @@ class PlayStoreImporter(AppInfoImporter):
 				if app.name:
 					logger.info(f"Found name for {app.id}: {app.name}")
 			else:
-				app.store_page_url = None
+				raise AppNotFoundError(f"Play Store page for {app.id} does not exist")
 		if app.store_page_url and not app.privacy_policy_url:
 			app.privacy_policy_url = self.import_privacy_policy_url(app)
 			if app.privacy_policy_url:
@@ -7,6 +7,7 @@ import configs
 import datetime
 
 from enum import Enum
+from model.app import Application
 from model.mdm import DeviceOwnership
 from threading import Thread, Timer
 from queue import Queue
@@ -30,6 +31,17 @@ class DeviceImporter(abc.ABC):
 		"""Fetch a list of all devices from this data source"""
 		pass
 
+	def load_state(self, state):
+		"""
+		Restore state saved by a previous run of the server, such as the time of the last sync
+		:param state: Dictionary returned by saved_state, empty if nothing has been saved
+		"""
+		pass
+
+	def saved_state(self):
+		"""Returns a JSON-serializable dictionary to save in DevicesRepository after each import, or None"""
+		return None
+
 	@abc.abstractmethod
 	def next_fetch_time(self):
 		"""
@@ -73,6 +85,7 @@ class DeviceImporterThread:
 
 	# Add new importer to queue
 	def queue_import(self, importer):
+		importer.load_state(self.devices_repo.importer_state(type(importer).__name__))
 		importer.connect()
 		next_fetch_time = importer.next_fetch_time()
 		if next_fetch_time:
@@ -99,7 +112,7 @@ class DeviceImporterThread:
 
 					logger.info(f"Got {len(apps)} ({len(system_apps)} system) apps from {type(importer).__name__}")
 					for app in apps:
-						# TODO: Add count
+						apps[app].info.install_count = apps[app].count
 						self.application_repo.add_or_update_app(apps[app].info)
 
 					logger.info(f"Got {len(devices)} devices from {type(importer).__name__}")
@@ -108,6 +121,32 @@ class DeviceImporterThread:
 							logger.warning(f"Device {device.name} is user-owned, analysis will be incomplete!")
 						self.devices_repo.add_or_replace_device(devices[device])
 
+					# Incremental syncs don't fetch the tenant-wide list of apps, so apps that first appear on a changed device
+					# are added here instead of waiting for the next full sync
+					new_apps = 0
+					if not apps:
+						app_ids_for_os = {}
+						for device in devices.values():
+							app_ids_for_os.setdefault(device.os, set()).update(device.discovered_apps)
+
+						for os, app_ids in app_ids_for_os.items():
+							for app_id in app_ids:
+								app = Application(app_id, os)
+								if not self.application_repo.app(app.unique_id()):
+									self.application_repo.add_or_update_app(app)
+									new_apps += 1
+					if new_apps:
+						logger.info(f"Added {new_apps} apps discovered on devices from {type(importer).__name__}")
+
+					# Readers see the apps and devices from this import at once
+					self.application_repo.publish()
+					self.devices_repo.publish()
+
+					# The state is saved in the same flush as the devices
+					state = importer.saved_state()
+					if state is not None:
+						self.devices_repo.update_importer_state(type(importer).__name__, state)
+
 					next_fetch_time = importer.next_fetch_time()
 					if next_fetch_time:
 						delay = abs(round((next_fetch_time - datetime.datetime.now()).total_seconds()))
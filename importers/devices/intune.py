@@ -1,17 +1,22 @@
 # Copyright (c) 2024 Hannes Mann, Alexander Wigren
 # See LICENSE for details
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from loguru import logger
+from threading import Lock
+from time import sleep
+from urllib.parse import urlparse
 
 import datetime
 import msal
-import requests
+import network
 import configs
 
-from mergedeep import Strategy, merge
 from munch import Munch
-from ratelimit import sleep_and_retry, limits
 
+from importers.apps.limiter import wait_for_host
 from importers.devices.importer import DeviceImporter
 
 from model.app import OperatingSystem, Application
@@ -30,68 +35,244 @@ intune_supported_operating_systems = {
 	"iOS": OperatingSystem.IOS,
 }
 
+graph_url = "https://graph.microsoft.com/beta"
+
+def detected_app_id(app):
+	"""Returns the package ID of a detectedApp, without the dots and spaces that Intune sometimes adds around it"""
+	return app["displayName"].strip(". ")
+
+def retry_after(headers, default=1):
+	"""Returns the number of seconds in a Retry-After header"""
+	for header, value in (headers or {}).items():
+		if header.lower() == "retry-after":
+			return int(value)
+	return default
+
 class IntuneImporter(DeviceImporter):
 	def __init__(self):
 		self.token = None
+		self.token_expires_at = None
 		self.last_fetch_time = None
 		self.request_counter = 0
 
+		# Optional repository.token_cache.TokenCacheRepository used to keep tokens between restarts
+		self.token_cache_repo = None
+		# The application and its token cache are reused by every connect
+		self.app = None
+		# Batch workers refresh the token from several threads
+		self.token_lock = Lock()
+
+		# Start times (UTC) of the last device sync and the last full sync, saved in DevicesRepository
+		self.last_device_sync = None
+		self.last_full_sync = None
+
+	def load_state(self, state):
+		if state.get("last_device_sync"):
+			self.last_device_sync = datetime.datetime.fromisoformat(state["last_device_sync"])
+		if state.get("last_full_sync"):
+			self.last_full_sync = datetime.datetime.fromisoformat(state["last_full_sync"])
+
+	def saved_state(self):
+		return {
+			"last_device_sync": self.last_device_sync.isoformat() if self.last_device_sync else None,
+			"last_full_sync": self.last_full_sync.isoformat() if self.last_full_sync else None
+		}
+
+	def is_full_sync_due(self):
+		"""
+		Full syncs download all discovered apps and devices
+		Incremental syncs in between only download devices that have checked in with Intune since the last sync
+		"""
+		if not self.last_device_sync or not self.last_full_sync:
+			return True
+		full_sync_timer = datetime.timedelta(seconds=configs.main.importers.intune.full_sync_timer)
+		return datetime.datetime.now(datetime.timezone.utc) - self.last_full_sync >= full_sync_timer
+
 	def connect(self):
 		if configs.secrets.api.intune.secret:
-			app = msal.ConfidentialClientApplication(
-				authority=configs.secrets.api.intune.authority,
-				client_id=configs.secrets.api.intune.client_id,
-				client_credential=configs.secrets.api.intune.secret
+			if not self.app:
+				token_cache = msal.SerializableTokenCache()
+				if self.token_cache_repo:
+					token_cache = self.token_cache_repo.load(type(self).__name__, configs.secrets.api.intune.secret)
 
-				# TODO: Connect msal.SerializableTokenCache to database
-				# token_cache=...
-			)
+				self.app = msal.ConfidentialClientApplication(
+					authority=configs.secrets.api.intune.authority,
+					client_id=configs.secrets.api.intune.client_id,
+					client_credential=configs.secrets.api.intune.secret,
+					# Token requests use the same pooled session as other requests to the authority
+					http_client=network.client.session_for_host(urlparse(configs.secrets.api.intune.authority).hostname),
+					token_cache=token_cache
+				)
 
-			token_result = app.acquire_token_silent(scopes=configs.secrets.api.intune.scope, account=None)
-			if not token_result:
-				token_result = app.acquire_token_for_client(scopes=configs.secrets.api.intune.scope)
+			# Since MSAL 1.23, acquire_token_for_client returns a cached token without contacting the authority
+			# until the token is about to expire (acquire_token_silent without an account never finds client tokens)
+			token_result = self.app.acquire_token_for_client(scopes=configs.secrets.api.intune.scope)
 
 			if "access_token" in token_result:
 				self.token = token_result["access_token"]
-				logger.info(f"Connected to Intune: {self.token}")
+				self.token_expires_at = datetime.datetime.now() + datetime.timedelta(seconds=token_result.get("expires_in", 0))
+				logger.info(f"Connected to Intune, token ({token_result.get('token_source', 'cache')}) expires at {self.token_expires_at:%Y-%m-%d %H:%M:%S}")
+
+				if self.token_cache_repo:
+					self.token_cache_repo.save(type(self).__name__, configs.secrets.api.intune.secret, self.app.token_cache)
 			else:
 				logger.error(f"Could not connect to Intune: {token_result.get('error')}")
 				logger.error(token_result.get("error_description"))
 
-	@sleep_and_retry
-	@limits(calls=20, period=10)
-	def intune_request(self, method, url):
-		headers = {"Authorization": f"Bearer {self.token}"}
+	def refresh_token(self):
+		"""
+		Get a new token before the current one expires, so that a sync is never interrupted by an expired token
+		The margin matches MSAL, which stops returning cached tokens 5 minutes before they expire
+		"""
+		with self.token_lock:
+			if self.token and self.token_expires_at and datetime.datetime.now() >= self.token_expires_at - datetime.timedelta(minutes=5):
+				self.connect()
+
+	def renew_rejected_token(self, token):
+		"""
+		Get a new token after Graph has rejected token with a 401, for example because it was revoked
+		If another thread has already replaced the token, the new token is used as is
+		"""
+		with self.token_lock:
+			if self.token == token:
+				# The rejected token would otherwise be returned from the cache until it expires
+				if self.app:
+					self.app.remove_tokens_for_client()
+				self.connect()
+
+	def graph_request(self, method, url, requests=1, **kwargs):
+		"""
+		Send a request to Graph after waiting for the rate limit of graph.microsoft.com
+		The token is checked before every request since a full sync can take longer than a token is valid,
+		and a request that is rejected with a 401 is sent once more with a new token
+
+		:param requests: Number of rate limit tokens the request takes, see send_batch
+		"""
+
+		for attempt in range(2):
+			self.refresh_token()
+			token = self.token
+
+			wait_for_host(url, requests)
+			self.request_counter += 1
+			res = network.request(method, url, headers={"Authorization": f"Bearer {token}"}, **kwargs)
+
+			if res.status_code != 401 or attempt:
+				return res
+			logger.warning("Graph rejected the Intune token, requesting a new one")
+			self.renew_rejected_token(token)
+
+	def intune_items(self, path):
+		"""
+		Send GET requests for a Graph collection and yield its items one page at a time
+		Every page is a separate request, see graph_request
+
+		:param path: Path relative to graph_url, for example "deviceManagement/managedDevices"
+		"""
+
 		# NOTE: The beta API has to be used to get a list of apps for a specific device
 		# The Intune portal uses the beta API
-		next_link = f"https://graph.microsoft.com/beta/{url}"
-		result = {}
+		next_link = f"{graph_url}/{path}"
 
 		while next_link:
-			self.request_counter += 1
+			res = self.graph_request("GET", next_link)
 			if configs.main.server.debug:
 				logger.info(f"Sent {self.request_counter} requests to Graph")
 
-			res = requests.request(method, next_link, headers=headers)
-			current_result = res.json()
-			result = merge({}, result, current_result, strategy=Strategy.ADDITIVE)
+			res.raise_for_status()
+			page = res.json()
+			yield from page["value"]
 
-			next_link = current_result.get("@odata.nextLink")
+			next_link = page.get("@odata.nextLink")
 			if next_link:
 				if configs.main.server.debug:
 					logger.info(f"Got more results from Graph: {next_link}")
 
-		return result
+	def send_batch(self, paths):
+		"""
+		Send GET requests for up to 20 paths in a single Graph JSON batch request
+		Requests throttled by Graph are retried after the time in Retry-After and @odata.nextLink pages are followed
+
+		:returns: Dictionary of path to items from every page
+		"""
+
+		results = {path: [] for path in paths}
+		# Sub-request ID to path and URL (relative to graph_url) of the next page
+		pending = {str(i): (path, f"/{path}") for i, path in enumerate(paths)}
+
+		while pending:
+			# Graph throttles each request in a batch separately, so every request takes a token
+			res = self.graph_request("POST", f"{graph_url}/$batch", len(pending), json={
+				"requests": [{"id": id, "method": "GET", "url": url} for id, (_, url) in pending.items()]
+			})
+
+			# The whole batch was throttled
+			if res.status_code == 429:
+				sleep(retry_after(res.headers))
+				continue
+			res.raise_for_status()
+
+			delay = 0
+			for response in res.json()["responses"]:
+				path, _ = pending[response["id"]]
+
+				if response["status"] == 429:
+					# Only this request was throttled, send it again with the next batch
+					delay = max(delay, retry_after(response.get("headers")))
+				elif response["status"] == 200:
+					results[path].extend(response["body"]["value"])
+
+					next_link = response["body"].get("@odata.nextLink")
+					if next_link:
+						pending[response["id"]] = (path, next_link.removeprefix(graph_url))
+					else:
+						del pending[response["id"]]
+				else:
+					logger.warning(f"Got {response['status']} from Graph for {path}")
+					del pending[response["id"]]
+
+			if pending and delay:
+				sleep(delay)
+
+		return results
+
+	def batch_request(self, paths):
+		"""
+		Send GET requests for many paths with Graph JSON batching
+		Batches are sent at the same time by configs.main.importers.intune.batch_workers threads
+
+		:param paths: Iterable of paths, read lazily so that at most batch_workers batches are held in memory
+		:returns: Generator of (path, items from every page) in the same order as paths
+		"""
+
+		# Graph allows up to 20 requests per batch
+		batch_size = min(configs.main.importers.intune.batch_size, 20)
+		paths = iter(paths)
+		batches = iter(lambda: list(islice(paths, batch_size)), [])
+		batch_workers = configs.main.importers.intune.batch_workers
+
+		with ThreadPoolExecutor(batch_workers, thread_name_prefix="GraphBatch") as executor:
+			# At most one batch per worker is in flight, the next batch is only read from paths when a result has been consumed
+			in_flight = deque(executor.submit(self.send_batch, batch) for batch in islice(batches, batch_workers))
+			while in_flight:
+				batch_results = in_flight.popleft().result()
+				for batch in islice(batches, 1):
+					in_flight.append(executor.submit(self.send_batch, batch))
+				yield from batch_results.items()
+
+		if configs.main.server.debug:
+			logger.info(f"Sent {self.request_counter} requests to Graph")
 
 	def	fetch_discovered_apps(self):
-		if self.token:
+		self.refresh_token()
+
+		# The tenant-wide list of apps is only downloaded during full syncs
+		if self.token and self.is_full_sync_due():
 			path = "deviceManagement/detectedApps?$select=displayName,platform,deviceCount"
-			discovered_apps = self.intune_request("get", path)["value"]
 			result = {}
 
-			for app in discovered_apps:
-				# Fix up the app ID
-				app_id = app["displayName"].strip(". ")
+			for app in self.intune_items(path):
+				app_id = detected_app_id(app)
 
 				if app["platform"] in intune_supported_platforms:
 					os = intune_supported_platforms[app["platform"]]
@@ -108,27 +289,42 @@ class IntuneImporter(DeviceImporter):
 		return {}
 
 	def	fetch_devices(self):
+		self.refresh_token()
+
 		if self.token:
+			sync_started = datetime.datetime.now(datetime.timezone.utc)
+			full_sync = self.is_full_sync_due()
+
 			path = "deviceManagement/managedDevices?$select=operatingSystem,id,deviceName,managedDeviceOwnerType"
-			discovered_devices = self.intune_request("get", path)["value"]
+			if not full_sync:
+				# Devices that synced while the previous request was running are included by going back a few minutes
+				since = self.last_device_sync - datetime.timedelta(minutes=10)
+				path += f"&$filter=lastSyncDateTime ge {since:%Y-%m-%dT%H:%M:%SZ}"
 			result = {}
 
-			# Fetch devices from Intune
-			for device in discovered_devices:
-				if device["operatingSystem"] in intune_supported_operating_systems:
-					os = intune_supported_operating_systems[device["operatingSystem"]]
-					ownership = DeviceOwnership.CORPORATE_OWNED
-					if device["managedDeviceOwnerType"] == "personal":
-						ownership = DeviceOwnership.USER_OWNED
-					result[device["id"]] = Device(device["id"], device["deviceName"].replace(" ", "_"), os, ownership)
-
-					# Fetch app device statuses and associate with our results
-					path = f"deviceManagement/managedDevices/{device['id']}/detectedApps?$select=displayName"
-					discovered_device_apps = self.intune_request("get", path)["value"]
-					for app in discovered_device_apps:
-						result[device["id"]].update_discovered_apps([app["displayName"]], False)
-				else:
-					logger.warning(f"Got device {device['id']} for unknown platform: {device['operatingSystem']}")
+			# Fetch devices from Intune, page by page
+			def detected_apps_paths():
+				for device in self.intune_items(path):
+					if device["operatingSystem"] in intune_supported_operating_systems:
+						os = intune_supported_operating_systems[device["operatingSystem"]]
+						ownership = DeviceOwnership.CORPORATE_OWNED
+						if device["managedDeviceOwnerType"] == "personal":
+							ownership = DeviceOwnership.USER_OWNED
+						result[device["id"]] = Device(device["id"], device["deviceName"].replace(" ", "_"), os, ownership)
+						yield f"deviceManagement/managedDevices/{device['id']}/detectedApps?$select=displayName"
+					else:
+						logger.warning(f"Got device {device['id']} for unknown platform: {device['operatingSystem']}")
+
+			# Fetch app device statuses in batches while devices are still being downloaded and associate with our results
+			for detected_apps_path, apps in self.batch_request(detected_apps_paths()):
+				device_id = detected_apps_path.split("/")[2]
+				# IDs are the same as in fetch_discovered_apps, so the apps on a device match the apps in the repository
+				result[device_id].update_discovered_apps(detected_app_id(app) for app in apps)
+
+			logger.info(f"{'Full' if full_sync else 'Incremental'} Intune sync found {len(result)} changed devices")
+			self.last_device_sync = sync_started
+			if full_sync:
+				self.last_full_sync = sync_started
 
 			self.last_fetch_time = datetime.datetime.now()
 			return result
@@ -137,8 +333,7 @@ class IntuneImporter(DeviceImporter):
 
 	def next_fetch_time(self):
 		if self.last_fetch_time:
-			# TODO: Add timedelta to config
-			return self.last_fetch_time + datetime.timedelta(days=1)
+			return self.last_fetch_time + datetime.timedelta(seconds=configs.main.importers.intune.sync_timer)
 		elif self.token:
 			return datetime.datetime.now()
 		return None
@@ -5,22 +5,31 @@
 
 import sys
 import configs
+import network
 
 from loguru import logger
 
 from argparse import ArgumentParser
-from sqlalchemy import create_engine
 
 from munch import Munch
 
 from api.restful import create_rest_api
 
 from repository.apps import ApplicationRepository
+from repository.database import create_database_engine
 from repository.devices import DevicesRepository
+from repository.exodus import ExodusRepository
+from repository.flusher import RepositoryFlusherThread
+from repository.http_cache import HttpCache
+from repository.migrations import migrate_database
+from repository.token_cache import TokenCacheRepository
 
+from importers.apps.exodus import ExodusImporter, ExodusMirrorThread
 from importers.apps.importer import AppInfoImporterThread
 from importers.devices.importer import DeviceImporterThread
+from importers.devices.intune import IntuneImporter
 from analysis.analyzer import AppAnalyzerThread
+from analysis.trackers import TrackerAnalyzer
 
 from defaults import *
 
@@ -46,32 +55,61 @@ if __name__ == "__main__":
 	if configs.main.server.debug:
 		logger.warning("configs.main.server.debug is set. Running Bottle and SQLAlchemy in debug mode.")
 
-	engine = create_engine(configs.main.server.database_url)
-	with engine.connect() as conn:
-		# Initialize repositories
-		app_repository = ApplicationRepository(conn)
-		devices_repository = DevicesRepository(conn)
-
-		with app_repository, devices_repository:
-			# Initialize importers
-			app_info_importer_thread = AppInfoImporterThread(app_repository, default_app_info_importers)
-			device_importer_thread = DeviceImporterThread(app_repository, devices_repository, default_device_importers)
-			# Initialize analyzers
-			app_analyzer_thread = AppAnalyzerThread(app_repository, devices_repository, default_app_analyzers)
-
-			# Initialize Bottle application
-			app = create_rest_api(
-				repositories=Munch(apps=app_repository, devices=devices_repository),
-				importers=Munch(apps=app_info_importer_thread, devices=device_importer_thread)
-			)
-
-			logger.info(f"Listening at http://{configs.main.server.host}:{configs.main.server.port}")
-			app.run(
-				host=configs.main.server.host,
-				port=configs.main.server.port,
-
-				debug=configs.main.server.debug,
-				quiet=not configs.main.server.debug,
-
-				server=configs.main.server.backend,
-			)
+	engine = create_database_engine(configs.main.server.database_url)
+	# Create tables and upgrade databases from older versions of the server
+	migrate_database(engine)
+
+	# Cache store pages and privacy policies between requests and restarts
+	if configs.main.network.cache.enabled:
+		network.client.cache = HttpCache(engine)
+
+	# Initialize repositories
+	app_repository = ApplicationRepository(engine)
+	devices_repository = DevicesRepository(engine)
+	exodus_repository = ExodusRepository(engine)
+
+	# Exodus Privacy reports and trackers are read from the local mirror when available
+	for component in default_app_info_importers + default_app_analyzers:
+		if isinstance(component, (ExodusImporter, TrackerAnalyzer)):
+			component.mirror = exodus_repository
+
+	# Tokens for Microsoft Graph are kept between restarts
+	token_cache_repository = TokenCacheRepository(engine)
+	for importer in default_device_importers:
+		if isinstance(importer, IntuneImporter):
+			importer.token_cache_repo = token_cache_repository
+
+	with app_repository, devices_repository:
+		# Initialize write-behind persistence
+		repository_flusher_thread = RepositoryFlusherThread((app_repository, devices_repository))
+
+		# Initialize importers
+		if configs.secrets.api.exodus and configs.main.importers.autorun:
+			exodus_mirror_thread = ExodusMirrorThread(exodus_repository, app_repository)
+		app_info_importer_thread = AppInfoImporterThread(app_repository, default_app_info_importers)
+		device_importer_thread = DeviceImporterThread(app_repository, devices_repository, default_device_importers)
+		# Initialize analyzers
+		app_analyzer_thread = AppAnalyzerThread(app_repository, devices_repository, default_app_analyzers)
+
+		# Initialize Bottle application
+		app = create_rest_api(
+			repositories=Munch(apps=app_repository, devices=devices_repository),
+			importers=Munch(apps=app_info_importer_thread, devices=device_importer_thread)
+		)
+
+		logger.info(f"Listening at http://{configs.main.server.host}:{configs.main.server.port}")
+		app.run(
+			host=configs.main.server.host,
+			port=configs.main.server.port,
+
+			debug=configs.main.server.debug,
+			quiet=not configs.main.server.debug,
+
+			server=configs.main.server.backend,
+		)
+
+		# Remaining changes are saved when the repositories are closed
+		repository_flusher_thread.stop()
+
+	# Close pooled connections
+	engine.dispose()
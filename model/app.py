@@ -2,9 +2,12 @@
 # See LICENSE for details
 
 from enum import Enum
-from fnmatch import fnmatchcase
+from fnmatch import translate
+from threading import Lock
 
 import configs
+import re
+import sys
 
 class OperatingSystem(str, Enum):
 	"""Enumeration of supported mobile operating systems"""
@@ -13,10 +16,96 @@ class OperatingSystem(str, Enum):
 	ANDROID = "android"
 	IOS = "ios"
 
+class NameTable:
+	"""
+	Assigns a bit to each distinct permission or tracker name
+	The same names are used by many apps, so apps store a bitset instead of a list of strings
+	"""
+
+	def __init__(self):
+		self.bits = {}
+		self.names = []
+		self.lock = Lock()
+
+	def encode(self, names):
+		"""Returns a bitset with the bits for names set"""
+
+		bitset = 0
+		for name in names or []:
+			# Exodus Privacy tracker IDs are integers, but they are stored and looked up as strings
+			name = sys.intern(str(name))
+			bit = self.bits.get(name)
+			if bit is None:
+				with self.lock:
+					bit = self.bits.get(name)
+					if bit is None:
+						bit = len(self.names)
+						self.names.append(name)
+						self.bits[name] = bit
+			bitset |= 1 << bit
+		return bitset
+
+	def decode(self, bitset):
+		"""Returns a tuple of names for a bitset, or None if no bits are set"""
+
+		names = []
+		while bitset:
+			lowest = bitset & -bitset
+			names.append(self.names[lowest.bit_length() - 1])
+			bitset ^= lowest
+		return tuple(names) or None
+
+permission_names = NameTable()
+tracker_names = NameTable()
+
+class SystemAppMatcher:
+	"""
+	Matches app IDs against the patterns in configs.main.analysis.system_apps
+	Patterns for each OS are compiled into a single regex and the result for each app is cached until configs are reloaded
+	"""
+
+	def __init__(self):
+		# Configs version, compiled regex for each OS and cached results for (OS, app ID)
+		self.state = (None, {}, {})
+
+	def compile(self):
+		patterns = {
+			OperatingSystem.ANDROID: configs.main.analysis.system_apps.android,
+			OperatingSystem.IOS: configs.main.analysis.system_apps.ios
+		}
+
+		compiled = {}
+		for os, os_patterns in patterns.items():
+			if os_patterns:
+				# Same as fnmatchcase(id, pattern) or id == pattern for any of the patterns
+				compiled[os] = re.compile("|".join(
+					f"{translate(pattern)}|{re.escape(pattern)}\\Z" for pattern in os_patterns
+				))
+
+		self.state = (configs.version, compiled, {})
+		return self.state
+
+	def is_system_app(self, app):
+		state = self.state
+		if state[0] != configs.version:
+			state = self.compile()
+
+		_, compiled, results = state
+		key = (app.os, app.id)
+		if key not in results:
+			regex = compiled.get(app.os)
+			results[key] = bool(regex and regex.match(app.id))
+		return results[key]
+
+system_app_matcher = SystemAppMatcher()
+
 class Application:
 	"""Represents a mobile application"""
 
-	def __init__(self, id, os, name=None, permissions=None, trackers=None, store_page_url=None, privacy_policy_url=None, other_os_id=None):
+	# Many thousands of apps are kept in memory, so no __dict__ is allocated for each app
+	__slots__ = ("id", "os", "name", "permission_bits", "tracker_bits", "store_page_url", "privacy_policy_url", "other_os_id", "install_count")
+
+	def __init__(self, id, os, name=None, permissions=None, trackers=None, store_page_url=None, privacy_policy_url=None, other_os_id=None, install_count=None):
 		"""
 		:param id: Application ID (Android), Bundle ID (iOS)
 		:param os: Operating system this application was developed for
@@ -29,41 +118,44 @@ class Application:
 		:param privacy_policy_url: Privacy policy provided by the developer
 
 		:param other_os_id: Application ID for this app on the other operating system (IOS=>ANDROID, ANDROID=>IOS)
+
+		:param install_count: Number of managed devices with this application installed, as reported by the device importer
 		"""
 
 		self.id = id
 		self.os = os
 		self.name = name
 
-		self.permissions = None
-		if permissions:
-			self.permissions = set()
-			for permission in permissions:
-				self.permissions.add(permission)
-			# Convert to list to make json.dump happy
-			self.permissions = list(self.permissions)
-
-		self.trackers = None
-		if trackers:
-			self.trackers = set()
-			for tracker in trackers:
-				self.trackers.add(tracker)
-			self.trackers = list(self.trackers)
+		self.permissions = permissions
+		self.trackers = trackers
 
 		self.store_page_url = store_page_url
 		self.privacy_policy_url = privacy_policy_url
 
 		self.other_os_id = other_os_id
 
-	def is_system_app(self):
-		patterns = []
+		self.install_count = install_count
 
-		if self.os == OperatingSystem.ANDROID:
-			patterns = configs.main.analysis.system_apps.android
-		elif self.os == OperatingSystem.IOS:
-			patterns = configs.main.analysis.system_apps.ios
+	@property
+	def permissions(self):
+		"""Permissions granted to this application, or None if they are unknown"""
+		return permission_names.decode(self.permission_bits)
 
-		return any([fnmatchcase(self.id, p) or self.id == p for p in patterns])
+	@permissions.setter
+	def permissions(self, permissions):
+		self.permission_bits = permission_names.encode(permissions)
+
+	@property
+	def trackers(self):
+		"""Trackers identified in the application, or None if they are unknown"""
+		return tracker_names.decode(self.tracker_bits)
+
+	@trackers.setter
+	def trackers(self, trackers):
+		self.tracker_bits = tracker_names.encode(trackers)
+
+	def is_system_app(self):
+		return system_app_matcher.is_system_app(self)
 
 	def is_complete_app(self):
 		"""Returns true if this app has all the information possible for this operating system"""
@@ -76,3 +168,18 @@ class Application:
 	def unique_id(self):
 		"""Return a unique ID across operating systems"""
 		return f"{self.id}_{self.os.name}"
+
+	def to_dict(self):
+		"""Returns a dictionary that can be serialized to JSON"""
+
+		return {
+			"id": self.id,
+			"os": self.os,
+			"name": self.name,
+			"permissions": self.permissions,
+			"trackers": self.trackers,
+			"store_page_url": self.store_page_url,
+			"privacy_policy_url": self.privacy_policy_url,
+			"other_os_id": self.other_os_id,
+			"install_count": self.install_count
+		}
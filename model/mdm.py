@@ -1,9 +1,14 @@
 # Copyright (c) 2024 Hannes Mann, Alexander Wigren
 # See LICENSE for details
 
+from array import array
+from bisect import bisect_left
 from enum import Enum
+from threading import Lock
 from time import time
 
+import sys
+
 class DeviceOwnership(str, Enum):
 	"""
 	Ownership of device in MDM environment
@@ -13,9 +18,29 @@ class DeviceOwnership(str, Enum):
 	CORPORATE_OWNED = "corporate_owned"
 	USER_OWNED = "user_owned"
 
+# Package IDs are shared by many devices, so each device stores an integer handle per app instead of a string
+app_handles = {}
+app_handle_ids = []
+app_handles_lock = Lock()
+
+def app_handle(package_id):
+	"""Returns the handle for a package ID, creating a new handle if needed"""
+
+	handle = app_handles.get(package_id)
+	if handle is None:
+		with app_handles_lock:
+			handle = app_handles.get(package_id)
+			if handle is None:
+				handle = len(app_handle_ids)
+				app_handle_ids.append(sys.intern(package_id))
+				app_handles[package_id] = handle
+	return handle
+
 class Device:
 	"""Represents a managed user device"""
 
+	__slots__ = ("id", "name", "os", "ownership", "discovered_app_handles", "sorted_app_handles")
+
 	def __init__(self, id, name, os, ownership):
 		"""
 		:param id: Unique ID of this device (example: "446925a3-64b7-4d7e-9e6e-0f9ab11b31d9")
@@ -28,37 +53,83 @@ class Device:
 		self.name = name
 		self.os = os
 		self.ownership = ownership
-		self.discovered_apps = []
+		# Unsigned int array of handles from app_handle(), in the order the apps were discovered
+		self.discovered_app_handles = array("I")
+		# (discovered_app_handles, sorted copy) for is_app_installed, only created for devices that are queried
+		self.sorted_app_handles = None
+
+	@property
+	def discovered_apps(self):
+		"""List of discovered application package IDs in the order they were discovered"""
+		return [app_handle_ids[handle] for handle in self.discovered_app_handles]
 
 	def update_discovered_apps(self, apps, replace=True):
 		"""
-		:param apps: Discovered apps from a data source such as MDM
-		:type apps: list or set
+		:param apps: Discovered apps from a data source such as MDM, apps that were already discovered are skipped
+		:type apps: Iterable of model.Application or package IDs
 		:param replace: If set to true, the existing set of discovered apps will be cleared
 		"""
 
-		if replace:
-			self.discovered_apps = []
+		# A new array is assigned since copies of this device may share the current one
+		handles = array("I") if replace else array("I", self.discovered_app_handles)
+		# Only used while adding apps, so devices don't keep a set in memory
+		seen = set(handles)
 
 		for app in apps:
 			# List of model.Application
-			if hasattr(app, "id") and app.id not in self.discovered_apps:
-				self.discovered_apps.append(app.id)
+			if hasattr(app, "id"):
+				handle = app_handle(app.id)
 			# List of application package IDs
-			elif isinstance(app, str) and app not in self.discovered_apps:
-				self.discovered_apps.append(app)
+			elif isinstance(app, str):
+				handle = app_handle(app)
 			else:
 				raise TypeError("Discovered apps should be a list of model.Application or package IDs")
 
+			if handle not in seen:
+				seen.add(handle)
+				handles.append(handle)
+
+		self.discovered_app_handles = handles
+		self.sorted_app_handles = None
+
 	def is_app_installed(self, package_id):
 		"""
 		:param package_id: Application package ID
 		"""
-		return self.discovered_apps[package_id]
+
+		handle = app_handles.get(package_id)
+		if handle is None:
+			return False
+
+		# The sorted copy belongs to the array it was made from, so it is never used after the apps have changed
+		handles = self.discovered_app_handles
+		cached = self.sorted_app_handles
+		if cached is None or cached[0] is not handles:
+			cached = (handles, array("I", sorted(handles)))
+			self.sorted_app_handles = cached
+
+		sorted_handles = cached[1]
+		index = bisect_left(sorted_handles, handle)
+		return index < len(sorted_handles) and sorted_handles[index] == handle
+
+	def discovered_app_unique_ids(self):
+		"""Returns the unique IDs (see Application.unique_id) of discovered apps"""
+		return [f"{app}_{self.os.name}" for app in self.discovered_apps]
+
+	def to_dict(self):
+		"""Returns a dictionary that can be serialized to JSON"""
+
+		return {
+			"id": self.id,
+			"name": self.name,
+			"os": self.os,
+			"ownership": self.ownership,
+			"discovered_apps": self.discovered_apps
+		}
 
 	def has_user_apps(self):
 		"""
 		Determines if all apps on the device, including user apps, have been discovered
 		Only corporate-owned devices allow access to the user profile
 		"""
-		return self.ownership == DeviceOwnership.CORPORATE_OWNED and len(self.discovered_apps) > 0
+		return self.ownership == DeviceOwnership.CORPORATE_OWNED and len(self.discovered_app_handles) > 0
@@ -0,0 +1,182 @@
+# Copyright (c) 2024 Hannes Mann, Alexander Wigren
+# See LICENSE for details
+
+from requests.adapters import HTTPAdapter
+from threading import Lock
+from time import perf_counter
+from urllib.parse import urlparse
+from urllib3.util.retry import Retry
+
+import configs
+import requests
+
+class HostStatistics:
+	"""Counters for requests sent to a single host"""
+
+	def __init__(self):
+		self.requests = 0
+		self.failed_requests = 0
+		# Responses served from the cache without a request, and responses revalidated with a 304
+		self.cache_hits = 0
+		self.cache_revalidations = 0
+		self.total_latency = 0.0
+		self.max_latency = 0.0
+
+class HttpClient:
+	"""
+	Shared HTTP client for all outbound requests (app stores, Exodus Privacy, Microsoft Graph, etc.)
+
+	Each host gets its own session and connection pool, so connections are kept alive between requests.
+	Requests have default timeouts from configs.main.network and are retried with exponential backoff on
+	429 and 5xx responses, waiting for the time in the Retry-After header if there is one.
+	"""
+
+	def __init__(self):
+		self.sessions = {}
+		self.adapters = {}
+		self.statistics = {}
+		self.lock = Lock()
+
+		# Optional repository.http_cache.HttpCache used by cached_get
+		self.cache = None
+
+	def session_for_host(self, host):
+		with self.lock:
+			if host not in self.sessions:
+				retry = Retry(
+					total=configs.main.network.retries,
+					backoff_factor=configs.main.network.backoff_factor,
+					status_forcelist=(429, 500, 502, 503, 504),
+					respect_retry_after_header=True,
+					# Return the last response after all retries so callers can check the status code
+					raise_on_status=False
+				)
+				adapter = HTTPAdapter(pool_maxsize=configs.main.network.pool_size, max_retries=retry)
+
+				session = requests.Session()
+				session.mount("http://", adapter)
+				session.mount("https://", adapter)
+
+				self.sessions[host] = session
+				self.adapters[host] = adapter
+			return self.sessions[host]
+
+	def statistics_for_host(self, host):
+		"""Must be called with self.lock held"""
+		if host not in self.statistics:
+			self.statistics[host] = HostStatistics()
+		return self.statistics[host]
+
+	def request(self, method, url, **kwargs):
+		"""Same as requests.request, using the shared session for the host of url"""
+
+		host = urlparse(url).hostname
+		session = self.session_for_host(host)
+		kwargs.setdefault("timeout", (configs.main.network.connect_timeout, configs.main.network.read_timeout))
+
+		start = perf_counter()
+		try:
+			return session.request(method, url, **kwargs)
+		except Exception:
+			with self.lock:
+				self.statistics_for_host(host).failed_requests += 1
+			raise
+		finally:
+			latency = perf_counter() - start
+			with self.lock:
+				statistics = self.statistics_for_host(host)
+				statistics.requests += 1
+				statistics.total_latency += latency
+				statistics.max_latency = max(statistics.max_latency, latency)
+
+	def get(self, url, **kwargs):
+		return self.request("get", url, **kwargs)
+
+	def post(self, url, **kwargs):
+		return self.request("post", url, **kwargs)
+
+	def cached_get(self, url, before_request=None, **kwargs):
+		"""
+		Same as get, but successful responses are stored in self.cache and revalidated with conditional requests
+
+		:param before_request: Called with url before a request is sent, for example to wait for a rate limit
+		Responses that are still fresh in the cache are returned without calling before_request
+		"""
+
+		if not self.cache:
+			if before_request:
+				before_request(url)
+			return self.get(url, **kwargs)
+
+		host = urlparse(url).hostname
+		cached = self.cache.get(url)
+
+		if cached and self.cache.is_fresh(cached, host):
+			with self.lock:
+				self.statistics_for_host(host).cache_hits += 1
+			return self.cache.to_response(cached)
+
+		if cached:
+			kwargs["headers"] = {**kwargs.get("headers", {}), **self.cache.revalidation_headers(cached)}
+
+		if before_request:
+			before_request(url)
+		res = self.get(url, **kwargs)
+
+		if cached and res.status_code == 304:
+			# Unchanged since the last download
+			self.cache.mark_validated(url)
+			with self.lock:
+				self.statistics_for_host(host).cache_revalidations += 1
+			return self.cache.to_response(cached)
+
+		if res.status_code == 200:
+			self.cache.put(url, res)
+		return res
+
+	def host_statistics(self):
+		"""Returns a dictionary of host to request counters, reused connections and latency in ms"""
+
+		result = {}
+		with self.lock:
+			for host, statistics in self.statistics.items():
+				# Every request that didn't need a new connection reused one from the pool
+				connections = 0
+				pool_requests = 0
+				# Hosts with only cached responses don't have a connection pool
+				pools = self.adapters[host].poolmanager.pools if host in self.adapters else {}
+				for key in pools.keys():
+					pool = pools.get(key)
+					if pool:
+						connections += pool.num_connections
+						pool_requests += pool.num_requests
+
+				result[host] = {
+					"requests": statistics.requests,
+					"failed_requests": statistics.failed_requests,
+					"cache_hits": statistics.cache_hits,
+					"cache_revalidations": statistics.cache_revalidations,
+					"connections": connections,
+					"reused_connections": max(pool_requests - connections, 0),
+					"avg_latency_ms": round(statistics.total_latency / statistics.requests * 1000.0, 2) if statistics.requests else None,
+					"max_latency_ms": round(statistics.max_latency * 1000.0, 2)
+				}
+		return result
+
+client = HttpClient()
+
+def get(url, **kwargs):
+	"""Send a GET request with the shared client"""
+	return client.get(url, **kwargs)
+
+def cached_get(url, before_request=None, **kwargs):
+	"""Send a GET request with the shared client, using the HTTP cache if it is enabled"""
+	return client.cached_get(url, before_request, **kwargs)
+
+def post(url, **kwargs):
+	"""Send a POST request with the shared client"""
+	return client.post(url, **kwargs)
+
+def request(method, url, **kwargs):
+	"""Send a request with the shared client"""
+	return client.request(method, url, **kwargs)
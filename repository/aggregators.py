@@ -0,0 +1,138 @@
+# Copyright (c) 2024 Hannes Mann, Alexander Wigren
+# See LICENSE for details
+
+from bisect import bisect_left, insort
+from fractions import Fraction
+from math import ceil
+
+import abc
+
+class Aggregator(abc.ABC):
+	"""
+	Combines risk scores into a single value that can be updated incrementally
+
+	Adding and removing values gives the same result as combining all values from scratch,
+	so the result does not depend on the order in which values were added.
+	Aggregators don't remember which app or device a value came from, since there is one aggregator per device.
+	To replace a value, the caller removes the exact value and weight it added before and adds the new one.
+	"""
+
+	def __init__(self):
+		self.count = 0
+
+	def add(self, value, weight=1.0):
+		self.count += 1
+		self.added(value, weight)
+
+	def remove(self, value, weight=1.0):
+		"""Remove a value and weight that was previously added"""
+		self.count -= 1
+		self.removed(value, weight)
+
+	def __len__(self):
+		return self.count
+
+	@abc.abstractmethod
+	def added(self, value, weight):
+		pass
+
+	@abc.abstractmethod
+	def removed(self, value, weight):
+		pass
+
+	@abc.abstractmethod
+	def value(self):
+		"""Returns the combined value, or None if no values have been added"""
+		pass
+
+class MeanAggregator(Aggregator):
+	"""Weighted arithmetic mean, with all weights set to 1.0 for a plain mean"""
+
+	def __init__(self, weighted=False):
+		super().__init__()
+		self.weighted = weighted
+		# Sums are kept as fractions so that adding and removing values never accumulates rounding errors
+		self.total = Fraction(0)
+		self.total_weight = Fraction(0)
+
+	def added(self, value, weight):
+		weight = Fraction(weight if self.weighted else 1)
+		self.total += Fraction(value) * weight
+		self.total_weight += weight
+
+	def removed(self, value, weight):
+		weight = Fraction(weight if self.weighted else 1)
+		self.total -= Fraction(value) * weight
+		self.total_weight -= weight
+
+	def value(self):
+		if not self.count or self.total_weight == 0:
+			return None
+		return float(self.total / self.total_weight)
+
+class PercentileAggregator(Aggregator):
+	"""
+	Nearest-rank percentile of all values, where the 100th percentile is the maximum
+
+	Values are counted, so adding or removing a value that is already present is O(1).
+	The first copy of a new value is inserted in a sorted list of distinct values, which is O(d) for d distinct values.
+	value() is O(1) for the maximum and walks down from the largest value for other percentiles.
+	Memory is O(d), not O(number of values).
+	"""
+
+	def __init__(self, percentile):
+		super().__init__()
+		self.percentile = percentile
+		# Number of times each value has been added, and the distinct values in ascending order
+		self.counts = {}
+		self.distinct_values = []
+
+	def added(self, value, weight):
+		count = self.counts.get(value)
+		if count:
+			self.counts[value] = count + 1
+		else:
+			self.counts[value] = 1
+			insort(self.distinct_values, value)
+
+	def removed(self, value, weight):
+		count = self.counts[value]
+		if count > 1:
+			self.counts[value] = count - 1
+		else:
+			del self.counts[value]
+			del self.distinct_values[bisect_left(self.distinct_values, value)]
+
+	def value(self):
+		if not self.count:
+			return None
+
+		# Position of the percentile counted from the largest value
+		position = self.count - 1 - percentile_rank(self.count, self.percentile)
+		for value in reversed(self.distinct_values):
+			count = self.counts[value]
+			if position < count:
+				return value
+			position -= count
+
+def percentile_rank(count, percentile):
+	"""Index of the nearest-rank percentile in a sorted list of count values"""
+	return max(ceil(count * percentile / 100) - 1, 0)
+
+# Valid values for configs.main.analysis.risk_score_method_*
+risk_score_methods = ("avg", "max", "p90", "weighted")
+
+def create_aggregator(method):
+	"""
+	:param method: One of risk_score_methods
+	"""
+
+	if method == "avg":
+		return MeanAggregator()
+	elif method == "weighted":
+		return MeanAggregator(weighted=True)
+	elif method == "max":
+		return PercentileAggregator(100)
+	elif method == "p90":
+		return PercentileAggregator(90)
+	raise ValueError(f"Invalid risk score method: {method}")
@@ -1,11 +1,16 @@
 # Copyright (c) 2024 Hannes Mann, Alexander Wigren
 # See LICENSE for details
 
+from datetime import datetime, timedelta
 from loguru import logger
 from model.app import Application, OperatingSystem
+from repository.aggregators import create_aggregator
 from sqlalchemy import *
+from threading import Lock, RLock
+from types import MappingProxyType
 
 import configs
+import copy
 
 metadata = MetaData()
 
@@ -22,25 +27,43 @@ apps = Table(
 	Column("store_page_url", String(255)),
 	Column("privacy_policy_url", String(255)),
 
-	Column("other_os_id", String(255))
+	Column("other_os_id", String(255)),
+
+	# Number of managed devices with the app installed, used to check the most common apps first
+	Column("install_count", Integer)
+)
+# Permission and tracker names are stored once in dictionary tables and referenced by ID
+permission_names = Table(
+	"android_permission_names",
+	metadata,
+
+	Column("id", Integer, primary_key=True),
+	Column("name", String(128), unique=True)
+)
+tracker_names = Table(
+	"android_tracker_names",
+	metadata,
+
+	Column("id", Integer, primary_key=True),
+	Column("name", String(128), unique=True)
 )
 permissions = Table(
-	"android_permissions",
+	"android_app_permissions",
 	metadata,
 
-	Column("app_id", String(255), ForeignKey("apps.id")),
-	Column("permission", String(128)),
+	Column("app_id", String(255), ForeignKey("apps.id"), index=True),
+	Column("permission_id", Integer, ForeignKey("android_permission_names.id")),
 
-	UniqueConstraint("app_id", "permission")
+	UniqueConstraint("app_id", "permission_id")
 )
 trackers = Table(
-	"android_trackers",
+	"android_app_trackers",
 	metadata,
 
-	Column("app_id", String(255), ForeignKey("apps.id")),
-	Column("tracker", String(128)),
+	Column("app_id", String(255), ForeignKey("apps.id"), index=True),
+	Column("tracker_id", Integer, ForeignKey("android_tracker_names.id")),
 
-	UniqueConstraint("app_id", "tracker")
+	UniqueConstraint("app_id", "tracker_id")
 )
 
 # Define tables for storing details about risk scores
@@ -56,162 +79,432 @@ detailed_risk_scores = Table(
 	"detailed_app_risk_scores",
 	metadata,
 
+	# Lookups by app use the primary key, since app_unique_id is its first column
 	Column("app_unique_id", String(255), primary_key=True),
 	Column("analyzer", String(255), primary_key=True),
 	Column("value", Double),
 )
 
+# Define table for apps that importers could not find, which are retried with exponential backoff
+import_failures = Table(
+	"app_import_failures",
+	metadata,
+
+	Column("app_unique_id", String(255), primary_key=True),
+	Column("importer", String(255), primary_key=True),
+	Column("failures", Integer),
+	Column("retry_at", DateTime)
+)
+
 class ApplicationRiskScore:
 	def __init__(self, value, sources, method):
 		self.overall_score = value
 		self.sources = sources
 		self.method = method
 
-def combine_risk_scores(current, next):
-	if not current:
-		return next
-	if configs.main.analysis.risk_score_method_app == "avg":
-		return (current + next) / 2.0
-	elif configs.main.analysis.risk_score_method_app == "max":
-		return max(current, next)
-	raise ValueError("Invalid configs.main.analysis.risk_score_method_app")
+	def applied_score(self):
+		"""Returns the (score, weight) that devices with the app add to their aggregates"""
+		# Apps are weighted by the number of analyzers that contributed to their risk score
+		return (self.overall_score, len(self.sources))
+
+class ImportFailure:
+	def __init__(self, failures, retry_at):
+		self.failures = failures
+		self.retry_at = retry_at
+
+def resolve_name_ids(conn, table, known_ids, names):
+	"""
+	Returns a dictionary of name to ID in android_permission_names or android_tracker_names
+	Names that are not in known_ids are added to the table
+	"""
+
+	ids = {}
+	for name in names:
+		if name in known_ids:
+			ids[name] = known_ids[name]
+		elif name not in ids:
+			# New names are rare since most apps share the same permissions and trackers
+			ids[name] = conn.execute(table.insert().values(name = name)).inserted_primary_key[0]
+	return ids
+
+def most_installed_first(apps):
+	"""Returns apps sorted by install count, so that work on apps installed on many devices is done first"""
+	return sorted(apps, key=lambda app: app.install_count or 0, reverse=True)
+
+class ApplicationRepositorySnapshot:
+	"""Read-only view of ApplicationRepository at a certain version"""
+
+	def __init__(self, version, apps, risk_scores):
+		self.version = version
+		self.apps = MappingProxyType(apps)
+		self.risk_scores = MappingProxyType(risk_scores)
 
 class ApplicationRepository:
 	"""Retreives information about applications from various sources and caches it in a database"""
 
-	def __init__(self, conn):
+	def __init__(self, engine):
 		"""
-		:param conn: SQLAlchemy database connection
+		:param engine: SQLAlchemy engine, a pooled connection is checked out for each unit of work
 		"""
-		self.conn = conn
+		self.engine = engine
 		self.apps = {}
 		self.risk_scores = {}
 
+		# IDs of rows in android_permission_names and android_tracker_names
+		self.permission_ids = {}
+		self.tracker_ids = {}
+
+		# Unique IDs of apps and risk scores that have changed since the last flush
+		self.dirty_apps = set()
+		self.dirty_risk_scores = set()
+
+		# (app unique ID, importer name) to ImportFailure for apps that importers could not find
+		self.import_failures = {}
+		self.dirty_import_failures = set()
+
+		# Work sets of apps that still need work, see add_work_set
+		self.work_sets = {}
+		self.work_sets_config_version = configs.version
+
+		# Protects the dictionaries above from concurrent modification
+		self.lock = RLock()
+		# Prevents the periodic flush and the flush at shutdown from overlapping
+		self.flush_lock = Lock()
+
+		# Incremented after every change, publish() only copies the dictionaries when something has changed
+		self.version = 0
+		self.published = ApplicationRepositorySnapshot(self.version, {}, {})
+
+	def snapshot(self):
+		"""
+		Returns a read-only view of the apps and risk scores at the last publish(), without waiting for writers
+		Other threads should iterate over a snapshot instead of the repository
+		"""
+		return self.published
+
+	def publish(self):
+		"""
+		Replace the snapshot with the current apps and risk scores
+		Importers and the analyzer call this once at the end of each pass instead of after every change
+		"""
+		with self.lock:
+			if self.published.version != self.version:
+				self.published = ApplicationRepositorySnapshot(self.version, dict(self.apps), dict(self.risk_scores))
+
+	# The methods below read a single value without the lock or a snapshot
+	# Apps and risk scores are replaced rather than modified, so a reader always sees a complete object
+
+	def app_count(self):
+		return len(self.apps)
+
+	def app(self, unique_id):
+		"""Returns the app with unique_id, or None"""
+		return self.apps.get(unique_id)
+
+	def risk_score(self, unique_id):
+		"""Returns the ApplicationRiskScore for an app, or None"""
+		return self.risk_scores.get(unique_id)
+
+	def add_work_set(self, key, predicate):
+		"""
+		Keep track of the apps for which predicate(app) is true, updated every time an app is added or updated
+		Importers use work sets to find apps that need more information without checking every app
+
+		:param key: Key of the work set, for example an AppInfoImporter
+		:param predicate: Function that returns true if an app needs work
+		"""
+		with self.lock:
+			self.work_sets[key] = (predicate, {unique_id for unique_id, app in self.apps.items() if predicate(app)})
+
+	def work_set(self, key):
+		"""Returns the apps in a work set, most installed first"""
+		with self.lock:
+			# Predicates can depend on configs (such as system apps), so work sets are rebuilt when configs are reloaded
+			if self.work_sets_config_version != configs.version:
+				self.rebuild_work_sets()
+
+			_, unique_ids = self.work_sets[key]
+			return most_installed_first(self.apps[unique_id] for unique_id in unique_ids)
+
+	def rebuild_work_sets(self):
+		with self.lock:
+			self.work_sets_config_version = configs.version
+			for key, (predicate, _) in self.work_sets.items():
+				self.work_sets[key] = (predicate, {unique_id for unique_id, app in self.apps.items() if predicate(app)})
+
+	def update_work_sets(self, app):
+		for predicate, unique_ids in self.work_sets.values():
+			if predicate(app):
+				unique_ids.add(app.unique_id())
+			else:
+				unique_ids.discard(app.unique_id())
+
+	def record_app_not_found(self, app, importer):
+		"""
+		Delay the next lookup of an app that an importer could not find
+		The delay doubles after every failure, up to configs.main.importers.not_found_max_backoff
+
+		:param importer: Name of the importer
+		:returns: Time of the next lookup
+		"""
+		with self.lock:
+			key = (app.unique_id(), importer)
+			failures = self.import_failures[key].failures + 1 if key in self.import_failures else 1
+			delay = min(
+				configs.main.importers.not_found_backoff * 2 ** (failures - 1),
+				configs.main.importers.not_found_max_backoff
+			)
+
+			self.import_failures[key] = ImportFailure(failures, datetime.now() + timedelta(seconds=delay))
+			self.dirty_import_failures.add(key)
+			return self.import_failures[key].retry_at
+
+	def clear_app_not_found(self, app, importer):
+		"""Forget previous failures after an importer has found the app"""
+		with self.lock:
+			key = (app.unique_id(), importer)
+			if key in self.import_failures:
+				del self.import_failures[key]
+				self.dirty_import_failures.add(key)
+
+	def is_app_import_delayed(self, app, importer):
+		"""Returns true if the importer could not find the app and should not look it up again yet"""
+		failure = self.import_failures.get((app.unique_id(), importer))
+		return failure is not None and failure.retry_at > datetime.now()
+
 	def add_or_update_app(self, app):
-		# Merge existing app
-		if app.unique_id() in self.apps:
-			current = self.apps[app.unique_id()]
-			current.name = app.name or current.name
-			current.permissions = app.permissions or current.permissions
-			current.trackers = app.trackers or current.trackers
-			current.store_page_url = app.store_page_url or current.store_page_url
-			current.privacy_policy_url = app.privacy_policy_url or current.privacy_policy_url
-			current.other_os_id = app.other_os_id or current.other_os_id
-		# Add to the list
-		else:
-			self.apps[app.unique_id()] = app
+		with self.lock:
+			# Merge existing app
+			if app.unique_id() in self.apps:
+				# Apps are copied on write since snapshots may still refer to the current object
+				current = copy.copy(self.apps[app.unique_id()])
+				current.name = app.name or current.name
+				current.permission_bits = app.permission_bits or current.permission_bits
+				current.tracker_bits = app.tracker_bits or current.tracker_bits
+				current.store_page_url = app.store_page_url or current.store_page_url
+				current.privacy_policy_url = app.privacy_policy_url or current.privacy_policy_url
+				current.other_os_id = app.other_os_id or current.other_os_id
+				# A count of 0 is valid, the app has been removed from every device
+				current.install_count = app.install_count if app.install_count is not None else current.install_count
+				self.apps[app.unique_id()] = current
+			# Add to the list
+			else:
+				self.apps[app.unique_id()] = app
+
+			self.update_work_sets(self.apps[app.unique_id()])
+			self.dirty_apps.add(app.unique_id())
+			self.version += 1
 
 	def update_risk_score_from_sources(self, app, sources):
-		overall_score = None
-		for source in sources:
-			overall_score = combine_risk_scores(overall_score, sources[source])
+		"""Returns true if the score or weight that devices use for the app has changed, see ApplicationRiskScore.applied_score"""
 
-		self.risk_scores[app.unique_id()] = ApplicationRiskScore(
-			overall_score,
-			sources,
-			configs.main.analysis.risk_score_method_app
-		)
+		aggregator = create_aggregator(configs.main.analysis.risk_score_method_app)
+		for source in sources:
+			aggregator.add(sources[source], configs.main.analysis.weights.get(source, 1.0))
+		overall_score = aggregator.value()
+		# Only sources with a weight of 0 were added, which doesn't give a weighted score
+		if overall_score is None:
+			logger.warning(f"Could not combine risk scores for app {app.id}, every source has a weight of 0")
+			return False
+
+		with self.lock:
+			previous = self.risk_scores.get(app.unique_id())
+			if previous and previous.overall_score == overall_score and previous.sources == sources:
+				return False
+
+			risk_score = ApplicationRiskScore(
+				overall_score,
+				sources,
+				configs.main.analysis.risk_score_method_app
+			)
+			self.risk_scores[app.unique_id()] = risk_score
+			self.dirty_risk_scores.add(app.unique_id())
+			self.version += 1
 
 		logger.info(f"Updated risk score for app {app.id}: {int(overall_score * 100)}% (from {len(sources)} sources)")
+		return not previous or previous.applied_score() != risk_score.applied_score()
 
 	def __enter__(self):
-		# Create default tables
-		metadata.create_all(self.conn)
-
-		# Get a list of existing applications
-		arows = self.conn.execute(apps.select()).all()
-		logger.success(f"Loaded {len(arows)} apps from database")
-
-		for arow in arows:
-			pset = set()
-			tset = set()
-
-			# Read android_permissions and android_trackers if this is an Android app
-			if arow.os == OperatingSystem.ANDROID:
-				prows = self.conn.execute(permissions.select().where(permissions.columns.app_id == arow.id)).all()
-				trows = self.conn.execute(trackers.select().where(trackers.columns.app_id == arow.id)).all()
-				for	prow in prows:
-					pset.add(prow.permission)
-				for	trow in trows:
-					tset.add(trow.tracker)
-
-			app = Application(
-				arow.id,
-				arow.os,
-				arow.name,
-				pset,
-				tset,
-				arow.store_page_url,
-				arow.privacy_policy_url,
-				arow.other_os_id
-			)
-			# Add application to repository
-			self.add_or_update_app(app)
-
-			# Check if risk score has been saved for this application
-			rrow = self.conn.execute(risk_scores.select().where(risk_scores.columns.app_unique_id == app.unique_id())).first()
-			if rrow:
-				sources = {}
+		# Tables are created and upgraded by repository.migrations before the repository is opened
+		with self.engine.begin() as conn:
+			# Each table is read once and grouped in memory to avoid one query per app
+			arows = conn.execute(apps.select()).all()
+
+			permission_names_by_id = {nrow.id: nrow.name for nrow in conn.execute(permission_names.select())}
+			tracker_names_by_id = {nrow.id: nrow.name for nrow in conn.execute(tracker_names.select())}
+			self.permission_ids = {name: id for id, name in permission_names_by_id.items()}
+			self.tracker_ids = {name: id for id, name in tracker_names_by_id.items()}
+
+			permissions_for_app = {}
+			for prow in conn.execute(permissions.select()):
+				permissions_for_app.setdefault(prow.app_id, set()).add(permission_names_by_id[prow.permission_id])
+
+			trackers_for_app = {}
+			for trow in conn.execute(trackers.select()):
+				trackers_for_app.setdefault(trow.app_id, set()).add(tracker_names_by_id[trow.tracker_id])
+
+			sources_for_app = {}
+			for drow in conn.execute(detailed_risk_scores.select()):
+				sources_for_app.setdefault(drow.app_unique_id, {})[drow.analyzer] = drow.value
+
+			for arow in arows:
+				pset = None
+				tset = None
+
+				# Permissions and trackers only apply to Android apps
+				if arow.os == OperatingSystem.ANDROID:
+					pset = permissions_for_app.get(arow.id)
+					tset = trackers_for_app.get(arow.id)
+
+				app = Application(
+					arow.id,
+					arow.os,
+					arow.name,
+					pset,
+					tset,
+					arow.store_page_url,
+					arow.privacy_policy_url,
+					arow.other_os_id,
+					arow.install_count
+				)
+				# Add application to repository
+				self.apps[app.unique_id()] = app
 
-				# Fetch a list of scores from analyzers
-				drows = self.conn.execute(detailed_risk_scores.select().where(detailed_risk_scores.columns.app_unique_id == app.unique_id())).all()
-				for drow in drows:
-					sources[drow.analyzer] = drow.value
+			for frow in conn.execute(import_failures.select()):
+				self.import_failures[(frow.app_unique_id, frow.importer)] = ImportFailure(frow.failures, frow.retry_at)
 
+			for rrow in conn.execute(risk_scores.select()):
 				# Retreive the overall and detailed scores
-				self.risk_scores[app.unique_id()] = ApplicationRiskScore(
+				self.risk_scores[rrow.app_unique_id] = ApplicationRiskScore(
 					rrow.overall_value,
-					sources,
+					sources_for_app.get(rrow.app_unique_id, {}),
 					rrow.method
 				)
 
+		self.rebuild_work_sets()
+		self.version += 1
+		self.publish()
+		logger.success(f"Loaded {len(self.apps)} apps from database")
+
+	def flush(self):
+		"""Write apps and risk scores that have changed since the last flush to the database"""
+
+		with self.flush_lock:
+			# Collect rows while holding the lock so importers and analyzers can continue while we write
+			with self.lock:
+				dirty_apps = self.dirty_apps
+				dirty_risk_scores = self.dirty_risk_scores
+				dirty_import_failures = self.dirty_import_failures
+				self.dirty_apps = set()
+				self.dirty_risk_scores = set()
+				self.dirty_import_failures = set()
+
+				app_rows = []
+				permission_rows = []
+				tracker_rows = []
+				for unique_id in dirty_apps:
+					app = self.apps[unique_id]
+					app_rows.append({
+						"id": app.id,
+						"os": app.os,
+						"name": app.name,
+						"store_page_url": app.store_page_url,
+						"privacy_policy_url": app.privacy_policy_url,
+						"other_os_id": app.other_os_id,
+						"install_count": app.install_count
+					})
+
+					# Save permissions and trackers if applicable
+					if app.os == OperatingSystem.ANDROID:
+						permission_rows.extend((app.id, p) for p in app.permissions or [])
+						tracker_rows.extend((app.id, t) for t in app.trackers or [])
+
+				risk_score_rows = []
+				detailed_risk_score_rows = []
+				for unique_id in dirty_risk_scores:
+					risk_score = self.risk_scores.get(unique_id)
+					if risk_score:
+						risk_score_rows.append({
+							"app_unique_id": unique_id,
+							"overall_value": risk_score.overall_score,
+							"method": risk_score.method
+						})
+						detailed_risk_score_rows.extend({
+							"app_unique_id": unique_id,
+							"analyzer": source,
+							"value": risk_score.sources[source]
+						} for source in risk_score.sources)
+
+				import_failure_rows = []
+				for unique_id, importer in dirty_import_failures:
+					failure = self.import_failures.get((unique_id, importer))
+					if failure:
+						import_failure_rows.append({
+							"app_unique_id": unique_id,
+							"importer": importer,
+							"failures": failure.failures,
+							"retry_at": failure.retry_at
+						})
+
+			if not dirty_apps and not dirty_risk_scores and not dirty_import_failures:
+				return
+
+			try:
+				with self.engine.begin() as conn:
+					# Changed rows are deleted and recreated with a single executemany per table
+					if app_rows:
+						conn.execute(
+							apps.delete().where(and_(apps.columns.id == bindparam("b_id"), apps.columns.os == bindparam("b_os"))),
+							[{"b_id": row["id"], "b_os": row["os"]} for row in app_rows]
+						)
+						conn.execute(apps.insert(), app_rows)
+
+					android_app_ids = [{"b_app_id": row["id"]} for row in app_rows if row["os"] == OperatingSystem.ANDROID]
+					if android_app_ids:
+						conn.execute(permissions.delete().where(permissions.columns.app_id == bindparam("b_app_id")), android_app_ids)
+						conn.execute(trackers.delete().where(trackers.columns.app_id == bindparam("b_app_id")), android_app_ids)
+
+					# Permission and tracker names are replaced by their IDs in the dictionary tables
+					resolved_permission_ids = resolve_name_ids(conn, permission_names, self.permission_ids, (p for _, p in permission_rows))
+					resolved_tracker_ids = resolve_name_ids(conn, tracker_names, self.tracker_ids, (t for _, t in tracker_rows))
+					if permission_rows:
+						conn.execute(permissions.insert(), [{"app_id": a, "permission_id": resolved_permission_ids[p]} for a, p in permission_rows])
+					if tracker_rows:
+						conn.execute(trackers.insert(), [{"app_id": a, "tracker_id": resolved_tracker_ids[t]} for a, t in tracker_rows])
+
+					if dirty_risk_scores:
+						unique_ids = [{"b_app_unique_id": unique_id} for unique_id in dirty_risk_scores]
+						conn.execute(risk_scores.delete().where(risk_scores.columns.app_unique_id == bindparam("b_app_unique_id")), unique_ids)
+						conn.execute(detailed_risk_scores.delete().where(detailed_risk_scores.columns.app_unique_id == bindparam("b_app_unique_id")), unique_ids)
+					if risk_score_rows:
+						conn.execute(risk_scores.insert(), risk_score_rows)
+					if detailed_risk_score_rows:
+						conn.execute(detailed_risk_scores.insert(), detailed_risk_score_rows)
+
+					if dirty_import_failures:
+						conn.execute(
+							import_failures.delete().where(and_(
+								import_failures.columns.app_unique_id == bindparam("b_app_unique_id"),
+								import_failures.columns.importer == bindparam("b_importer")
+							)),
+							[{"b_app_unique_id": unique_id, "b_importer": importer} for unique_id, importer in dirty_import_failures]
+						)
+					if import_failure_rows:
+						conn.execute(import_failures.insert(), import_failure_rows)
+			except:
+				# Try again during the next flush
+				with self.lock:
+					self.dirty_apps |= dirty_apps
+					self.dirty_risk_scores |= dirty_risk_scores
+					self.dirty_import_failures |= dirty_import_failures
+				raise
+
+			# IDs are only known to be valid once the transaction has been committed
+			self.permission_ids.update(resolved_permission_ids)
+			self.tracker_ids.update(resolved_tracker_ids)
+
+			logger.info(f"Saved {len(app_rows)} apps and {len(risk_score_rows)} risk scores to database")
 
 	def __exit__(self, *args):
-		# Applications are always deleted and recreated with INSERT
-		self.conn.execute(apps.delete())
-		for app in self.apps.values():
-			self.conn.execute(apps.insert().values(
-				id = app.id,
-				os = app.os,
-				name = app.name,
-				store_page_url = app.store_page_url,
-				privacy_policy_url = app.privacy_policy_url,
-				other_os_id = app.other_os_id
-			))
-
-			# Save to android_permissions and android_trackers if applicable
-			if app.os == OperatingSystem.ANDROID:
-				self.conn.execute(permissions.delete().where(permissions.columns.app_id == app.id))
-				for permission in app.permissions or []:
-					self.conn.execute(permissions.insert().values(app_id = app.id, permission = permission))
-
-				self.conn.execute(trackers.delete().where(trackers.columns.app_id == app.id))
-				for tracker in app.trackers or []:
-					self.conn.execute(trackers.insert().values(app_id = app.id, tracker = tracker))
-
-			# Risk scores are always deleted and recreated with INSERT
-			self.conn.execute(risk_scores.delete().where(risk_scores.columns.app_unique_id == app.unique_id()))
-			self.conn.execute(detailed_risk_scores.delete().where(detailed_risk_scores.columns.app_unique_id == app.unique_id()))
-
-			# Save risk score if applicable
-			if app.unique_id() in self.risk_scores:
-				risk_score = self.risk_scores[app.unique_id()]
-
-				# Save the overall score and method
-				self.conn.execute(risk_scores.insert().values(
-					app_unique_id = app.unique_id(),
-					overall_value = risk_score.overall_score,
-					method = risk_score.method
-				))
-
-				# Save all sources
-				for source in risk_score.sources:
-					self.conn.execute(detailed_risk_scores.insert().values(
-						app_unique_id = app.unique_id(),
-						analyzer = source,
-						value = risk_score.sources[source]
-					))
-
-		self.conn.commit()
-		logger.success(f"Saved {len(self.apps)} apps to database")
-
+		# Only changes that haven't been written by the flusher thread remain
+		self.flush()
@@ -0,0 +1,36 @@
+# Copyright (c) 2024 Hannes Mann, Alexander Wigren
+# See LICENSE for details
+
+from loguru import logger
+from sqlalchemy import create_engine, event, make_url
+
+import configs
+
+def create_database_engine(database_url):
+	"""
+	Create an SQLAlchemy engine with a connection pool configured in configs.main.server
+	Repositories check out a connection from the pool for each unit of work instead of sharing one connection
+
+	:param database_url: https://docs.sqlalchemy.org/en/20/core/engines.html#database-urls
+	"""
+
+	url = make_url(database_url)
+	options = {}
+
+	# In-memory SQLite databases use a single connection per thread and can't be pooled
+	if not (url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")):
+		options["pool_size"] = configs.main.server.pool_size
+		options["max_overflow"] = configs.main.server.pool_max_overflow
+
+	engine = create_engine(url, **options)
+
+	if url.get_backend_name() == "sqlite":
+		@event.listens_for(engine, "connect")
+		def enable_write_ahead_log(dbapi_connection, connection_record):
+			# WAL mode allows readers to continue while another connection is writing
+			cursor = dbapi_connection.cursor()
+			cursor.execute("PRAGMA journal_mode=WAL")
+			cursor.close()
+
+	logger.info(f"Connecting to {url.get_backend_name()} database with pool size {options.get('pool_size', 1)}")
+	return engine
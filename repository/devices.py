@@ -4,8 +4,12 @@
 from loguru import logger
 from model.app import OperatingSystem
 from model.mdm import Device, DeviceOwnership
+from repository.aggregators import create_aggregator
+from repository.vectorized import create_vectorized_engine
 from sqlalchemy import *
+from threading import Lock, RLock
 from time import time
+from types import MappingProxyType
 
 import configs
 
@@ -25,8 +29,8 @@ discovered_apps = Table(
 	"device_discovered_apps",
 	metadata,
 
-	Column("device_id", String(255), ForeignKey("devices.id")),
-	Column("app_id", String(255)),
+	Column("device_id", String(255), ForeignKey("devices.id"), index=True),
+	Column("app_id", String(255), index=True),
 
 	UniqueConstraint("device_id", "app_id")
 )
@@ -36,128 +40,443 @@ risk_scores = Table(
 	"device_risk_scores",
 	metadata,
 
-	Column("device_id", String(255), ForeignKey("devices.id")),
+	Column("device_id", String(255), ForeignKey("devices.id"), index=True),
 	Column("combined_value", Double)
 )
 
-def combine_device_risk_scores(current, next):
-	if not current:
-		return next
-	if configs.main.analysis.risk_score_method_device == "avg":
-		return (current + next) / 2.0
-	elif configs.main.analysis.risk_score_method_device == "max":
-		return max(current, next)
-	raise ValueError("Invalid configs.main.analysis.risk_score_method_device")
-
-def combine_organization_risk_scores(current, next):
-	if not current:
-		return next
-	if configs.main.analysis.risk_score_method_órganization == "avg":
-		return (current + next) / 2.0
-	elif configs.main.analysis.risk_score_method_órganization == "max":
-		return max(current, next)
-	raise ValueError("Invalid configs.main.analysis.risk_score_method_órganization")
+# Define table for state that device importers keep between runs of the server
+importer_states = Table(
+	"device_importer_states",
+	metadata,
+
+	Column("importer", String(255), primary_key=True),
+	Column("state", JSON)
+)
+
+def organization_groups(device):
+	"""Returns the groups that a device contributes to in the organization risk scores"""
+	return (("organization",), ("os", device.os.value), ("ownership", device.ownership.value))
+
+def organization_scores_by(organization_scores, kind):
+	"""
+	:param organization_scores: Dictionary of group in organization_groups() to combined risk score
+	:param kind: "os" or "ownership"
+	:returns: Dictionary of OS or ownership to combined risk score
+	"""
+	return {group[1]: score for group, score in organization_scores.items() if group[0] == kind and score is not None}
+
+class DevicesRepositorySnapshot:
+	"""Read-only view of DevicesRepository at a certain version"""
+
+	def __init__(self, version, devices, risk_scores, organization_scores):
+		self.version = version
+		self.devices = MappingProxyType(devices)
+		self.risk_scores = MappingProxyType(risk_scores)
+		self.organization_scores = MappingProxyType(organization_scores)
+
+	def organization_score(self):
+		"""Returns the risk score for the entire organization"""
+		return self.organization_scores.get(("organization",))
+
+	def organization_scores_by(self, kind):
+		return organization_scores_by(self.organization_scores, kind)
 
 class DevicesRepository:
 	"""Stores information about devices and caches it in a database"""
 
-	def __init__(self, conn):
+	def __init__(self, engine):
 		"""
-		:param conn: SQLAlchemy database connection
+		:param engine: SQLAlchemy engine, a pooled connection is checked out for each unit of work
 		"""
-		self.conn = conn
+		self.engine = engine
 		self.devices = {}
 		self.risk_scores = {}
 
-	def add_or_replace_device(self, device):
-		# Devices should always be replaced since complete information is always retrieved from MDM
-		self.devices[device.id] = device
+		# Inverted index from app unique ID to the IDs of devices that have the app installed
+		self.devices_for_app = {}
+		# IDs of devices that were added or replaced since risk scores were last updated
+		self.unscored_devices = set()
+
+		# Aggregate of app risk scores for each device, updated one app at a time
+		self.device_aggregators = {}
+		# App unique ID to the (score, weight) currently added to the aggregates of devices with the app
+		# Stored once per app rather than once per device, and used to remove the old score when it changes
+		self.applied_app_scores = {}
+		# Number of apps with a risk score on each device, used as weight for the organization score
+		self.analyzed_app_counts = {}
+
+		# Aggregates of device risk scores for the organization and each group in organization_groups()
+		self.organization_aggregators = {}
+		# Device ID to the (groups, score, weight) currently added to the organization aggregates
+		self.organization_contributions = {}
+		# Materialized organization risk scores, refreshed whenever device risk scores change
+		self.organization_scores = {}
+
+		# Optional NumPy engine that replaces the per-device Python loops
+		self.vectorized = create_vectorized_engine(configs.main.analysis.risk_score_engine)
+		# Set when devices have changed and the incidence matrix needs to be rebuilt
+		self.vectorized_stale = True
+
+		# IDs of devices and risk scores that have changed since the last flush
+		self.dirty_devices = set()
+		self.dirty_risk_scores = set()
+
+		# Importer name to state returned by DeviceImporter.saved_state
+		self.importer_states = {}
+		self.dirty_importer_states = set()
+
+		# Protects the dictionaries above from concurrent modification
+		self.lock = RLock()
+		# Prevents the periodic flush and the flush at shutdown from overlapping
+		self.flush_lock = Lock()
+
+		# Incremented after every change, publish() only copies the dictionaries when something has changed
+		self.version = 0
+		self.published = DevicesRepositorySnapshot(self.version, {}, {}, {})
+
+	def snapshot(self):
+		"""
+		Returns a read-only view of the devices and risk scores at the last publish(), without waiting for writers
+		Other threads should iterate over a snapshot instead of the repository
+		"""
+		return self.published
 
-	def update_risk_scores_from_repo(self, repo):
-		# Reset scores
-		self.risk_scores = {}
+	def publish(self):
+		"""
+		Replace the snapshot with the current devices and risk scores
+		Device importers call this once at the end of each import and risk scores are published after every update
+		"""
+		with self.lock:
+			if self.published.version != self.version:
+				self.published = DevicesRepositorySnapshot(self.version, dict(self.devices), dict(self.risk_scores), self.organization_scores)
 
-		for device in self.devices.values():
-			if len(device.discovered_apps) > 0:
-				combined_score = None
+	# The methods below read a single value without the lock or a snapshot
+	# Devices are replaced rather than modified and organization_scores is replaced by publish_organization_scores,
+	# so a reader always sees a complete object even while the repository is being written to
 
-				# Build an intersection of all apps that are both in the repo and device
-				# We need to build a list with the format "org.app.x_ANDROID", "com.app.y_IOS", etc to find risk scores
-				device_app_ids = map(lambda a: f"{a}_{device.os.name}", device.discovered_apps)
-				analyzed_device_apps = set(repo.risk_scores.keys()).intersection(device_app_ids)
-				for app in analyzed_device_apps:
-					combined_score = combine_device_risk_scores(combined_score, repo.risk_scores[app].overall_score)
+	def device_count(self):
+		return len(self.devices)
 
-				if combined_score:
-					self.risk_scores[device.id] = combined_score
-					logger.info(f"Updated risk score for device {device.name}: {int(combined_score * 100)}% (from {len(analyzed_device_apps)} apps)")
+	def device(self, device_id):
+		"""Returns the device with device_id, or None"""
+		return self.devices.get(device_id)
 
-	def combine_scores_for_organization(self):
-		combined_score = None
+	def risk_score(self, device_id):
+		"""Returns the combined risk score for a device, or None"""
+		return self.risk_scores.get(device_id)
 
-		for device in self.risk_scores:
-			combined_score = combine_organization_risk_scores(combined_score, self.risk_scores[device])
+	def organization_score(self):
+		"""Returns the risk score for the entire organization"""
+		return self.organization_scores.get(("organization",))
 
-		return combined_score
+	def organization_scores_by(self, kind):
+		"""
+		:param kind: "os" or "ownership"
+		:returns: Dictionary of OS or ownership to combined risk score
+		"""
+		return organization_scores_by(self.organization_scores, kind)
 
-	def __enter__(self):
-		# Create default tables
-		metadata.create_all(self.conn)
-
-		# Get a list of existing devices
-		drows = self.conn.execute(devices.select()).all()
-		logger.success(f"Loaded {len(drows)} devices from database")
-
-		for drow in drows:
-			device = Device(
-				drow.id,
-				drow.name,
-				drow.os,
-				drow.ownership
+	def add_or_replace_device(self, device):
+		with self.lock:
+			# Devices should always be replaced since complete information is always retrieved from MDM
+			if device.id in self.devices:
+				self.remove_from_index(self.devices[device.id])
+			self.devices[device.id] = device
+			self.add_to_index(device)
+
+			self.unscored_devices.add(device.id)
+			self.dirty_devices.add(device.id)
+			self.vectorized_stale = True
+			self.version += 1
+
+	def importer_state(self, importer):
+		"""Returns the saved state for an importer, or an empty dictionary"""
+		with self.lock:
+			return dict(self.importer_states.get(importer, {}))
+
+	def update_importer_state(self, importer, state):
+		with self.lock:
+			self.importer_states[importer] = state
+			self.dirty_importer_states.add(importer)
+
+	def add_to_index(self, device):
+		for app in device.discovered_app_unique_ids():
+			self.devices_for_app.setdefault(app, set()).add(device.id)
+
+	def remove_from_index(self, device):
+		for app in device.discovered_app_unique_ids():
+			device_ids = self.devices_for_app.get(app)
+			if device_ids:
+				device_ids.discard(device.id)
+				if not device_ids:
+					del self.devices_for_app[app]
+
+	def update_risk_scores_from_repo(self, repo, app_ids=None):
+		"""
+		Recompute risk scores for devices affected by changed app risk scores
+
+		:param repo: ApplicationRepository with app risk scores
+		:param app_ids: Unique IDs of apps with changed risk scores, or None to recompute all devices
+		"""
+
+		# App risk scores are read from the published snapshot, the analyzer publishes its scores before calling this
+		app_risk_scores = repo.snapshot().risk_scores
+
+		with self.lock:
+			if self.vectorized:
+				if app_ids is None or app_ids or self.unscored_devices:
+					self.update_risk_scores_vectorized(app_risk_scores)
+					self.publish()
+				return
+
+			if app_ids is None:
+				self.unscored_devices = set(self.devices.keys())
+
+			# Unscored devices are built from applied_app_scores, so every app is brought up to date first
+			if app_ids is None or self.unscored_devices:
+				app_ids = self.applied_app_scores.keys() | app_risk_scores.keys()
+
+			# Scored devices only need the changed apps replaced in their aggregate
+			affected_devices = set()
+			for app in app_ids:
+				risk_score = app_risk_scores.get(app)
+				applied_score = risk_score.applied_score() if risk_score else None
+				previous_score = self.applied_app_scores.get(app)
+				if applied_score == previous_score:
+					continue
+
+				if applied_score:
+					self.applied_app_scores[app] = applied_score
+				else:
+					del self.applied_app_scores[app]
+
+				for device_id in self.devices_for_app.get(app, ()):
+					if device_id in self.unscored_devices:
+						continue
+					if previous_score:
+						self.device_aggregators[device_id].remove(*previous_score)
+					if applied_score:
+						self.device_aggregators[device_id].add(*applied_score)
+					affected_devices.add(device_id)
+
+			# Devices that were replaced since the last update are scored from scratch
+			for device_id in self.unscored_devices:
+				if device_id in self.devices:
+					self.device_aggregators[device_id] = self.aggregate_device_apps(self.devices[device_id])
+					affected_devices.add(device_id)
+			self.unscored_devices = set()
+
+			for device_id in affected_devices:
+				self.update_risk_score_for_device(self.devices[device_id])
+
+			self.publish_organization_scores()
+			self.version += 1
+			self.publish()
+
+	def aggregate_device_apps(self, device):
+		aggregator = create_aggregator(configs.main.analysis.risk_score_method_device)
+
+		# Only apps that are both in the repo and on the device have a risk score
+		for app in device.discovered_app_unique_ids():
+			applied_score = self.applied_app_scores.get(app)
+			if applied_score:
+				aggregator.add(*applied_score)
+
+		return aggregator
+
+	def update_risk_score_for_device(self, device):
+		aggregator = self.device_aggregators[device.id]
+		combined_score = aggregator.value()
+
+		previous_score = self.risk_scores.get(device.id)
+		if combined_score is not None:
+			self.risk_scores[device.id] = combined_score
+			self.analyzed_app_counts[device.id] = len(aggregator)
+			logger.info(f"Updated risk score for device {device.name}: {int(combined_score * 100)}% (from {len(aggregator)} apps)")
+		else:
+			self.risk_scores.pop(device.id, None)
+			self.analyzed_app_counts.pop(device.id, None)
+
+		# Only scores that were added, removed or changed need to be saved
+		if previous_score != combined_score:
+			self.dirty_risk_scores.add(device.id)
+
+		self.update_organization_scores_for_device(device)
+
+	def update_risk_scores_vectorized(self, app_risk_scores):
+		if self.vectorized_stale:
+			self.vectorized.rebuild(self.devices)
+			self.vectorized_stale = False
+		self.unscored_devices = set()
+
+		# All devices are rescored at once, so compare with the previous scores to find changes
+		previous_risk_scores = self.risk_scores
+		self.risk_scores, self.analyzed_app_counts = self.vectorized.device_scores(app_risk_scores, configs.main.analysis.risk_score_method_device)
+		for device_id in previous_risk_scores.keys() | self.risk_scores.keys():
+			if previous_risk_scores.get(device_id) != self.risk_scores.get(device_id):
+				self.dirty_risk_scores.add(device_id)
+
+		logger.info(f"Updated risk scores for {len(self.risk_scores)} devices")
+		self.rebuild_organization_scores()
+		self.version += 1
+
+	def update_organization_scores_for_device(self, device):
+		# The device may have moved to another group since it was last scored
+		previous = self.organization_contributions.pop(device.id, None)
+		if previous:
+			groups, score, weight = previous
+			for group in groups:
+				self.organization_aggregators[group].remove(score, weight)
+
+		# Devices are weighted by the number of apps with a risk score
+		score = self.risk_scores.get(device.id)
+		if score is not None:
+			groups = organization_groups(device)
+			weight = self.analyzed_app_counts.get(device.id, 1)
+			for group in groups:
+				if group not in self.organization_aggregators:
+					self.organization_aggregators[group] = create_aggregator(configs.main.analysis.risk_score_method_organization)
+				self.organization_aggregators[group].add(score, weight)
+			self.organization_contributions[device.id] = (groups, score, weight)
+
+	def rebuild_organization_scores(self):
+		if self.vectorized:
+			scored_devices = [self.devices[d] for d in self.risk_scores if d in self.devices]
+			self.organization_scores = self.vectorized.organization_scores(
+				scored_devices,
+				self.risk_scores,
+				self.analyzed_app_counts,
+				organization_groups,
+				configs.main.analysis.risk_score_method_organization
 			)
+			return
 
-			discovered_apps_for_device = list()
-			# Read device_discovered_apps for existing discovered applications
-			arows = self.conn.execute(discovered_apps.select().where(discovered_apps.columns.device_id == drow.id)).all()
-			for	arow in arows:
-				discovered_apps_for_device.append(arow.app_id)
-			device.update_discovered_apps(discovered_apps_for_device)
+		self.organization_aggregators = {}
+		self.organization_contributions = {}
+		for device_id in self.risk_scores:
+			if device_id in self.devices:
+				self.update_organization_scores_for_device(self.devices[device_id])
+		self.publish_organization_scores()
 
-			# Add device to repository
-			self.add_or_replace_device(device)
+	def publish_organization_scores(self):
+		# There are only a few groups, so this is cheap compared to walking every device
+		# The dictionary is replaced rather than modified so readers don't need the lock
+		self.organization_scores = {group: aggregator.value() for group, aggregator in self.organization_aggregators.items()}
 
-			rrow = self.conn.execute(risk_scores.select().where(risk_scores.columns.device_id == device.id)).first()
-			if rrow:
+	def combine_scores_for_organization(self):
+		"""Returns the risk score for the entire organization"""
+		return self.organization_score()
+
+	def __enter__(self):
+		# Tables are created and upgraded by repository.migrations before the repository is opened
+		with self.engine.begin() as conn:
+			# Each table is read once and grouped in memory to avoid one query per device
+			drows = conn.execute(devices.select()).all()
+
+			discovered_apps_for_device = {}
+			for arow in conn.execute(discovered_apps.select()):
+				discovered_apps_for_device.setdefault(arow.device_id, []).append(arow.app_id)
+
+			for drow in drows:
+				device = Device(
+					drow.id,
+					drow.name,
+					drow.os,
+					drow.ownership
+				)
+				device.update_discovered_apps(discovered_apps_for_device.get(drow.id, []))
+
+				# Add device to repository
+				self.devices[device.id] = device
+				self.add_to_index(device)
+				# Aggregates are rebuilt from app risk scores during the next update
+				self.unscored_devices.add(device.id)
+
+			for rrow in conn.execute(risk_scores.select()):
 				# Retreive the combined score
 				self.risk_scores[rrow.device_id] = rrow.combined_value
 
+			for srow in conn.execute(importer_states.select()):
+				self.importer_states[srow.importer] = srow.state
+
+		self.rebuild_organization_scores()
+		self.version += 1
+		self.publish()
+
+		logger.success(f"Loaded {len(self.devices)} devices from database")
+
+	def flush(self):
+		"""Write devices and risk scores that have changed since the last flush to the database"""
+
+		with self.flush_lock:
+			# Collect rows while holding the lock so importers and analyzers can continue while we write
+			with self.lock:
+				dirty_devices = self.dirty_devices
+				dirty_risk_scores = self.dirty_risk_scores
+				dirty_importer_states = self.dirty_importer_states
+				self.dirty_devices = set()
+				self.dirty_risk_scores = set()
+				self.dirty_importer_states = set()
+
+				device_rows = []
+				discovered_app_rows = []
+				for device_id in dirty_devices:
+					device = self.devices[device_id]
+					device_rows.append({
+						"id": device.id,
+						"name": device.name,
+						"os": device.os,
+						"ownership": device.ownership
+					})
+					discovered_app_rows.extend({"device_id": device.id, "app_id": app} for app in device.discovered_apps)
+
+				risk_score_rows = [
+					{"device_id": device_id, "combined_value": self.risk_scores[device_id]}
+					for device_id in dirty_risk_scores if device_id in self.risk_scores
+				]
+
+				importer_state_rows = [
+					{"importer": importer, "state": self.importer_states[importer]}
+					for importer in dirty_importer_states
+				]
+
+			if not dirty_devices and not dirty_risk_scores and not dirty_importer_states:
+				return
+
+			try:
+				with self.engine.begin() as conn:
+					# Changed rows are deleted and recreated with a single executemany per table
+					if dirty_devices:
+						device_ids = [{"b_device_id": device_id} for device_id in dirty_devices]
+						conn.execute(devices.delete().where(devices.columns.id == bindparam("b_device_id")), device_ids)
+						conn.execute(discovered_apps.delete().where(discovered_apps.columns.device_id == bindparam("b_device_id")), device_ids)
+						conn.execute(devices.insert(), device_rows)
+					if discovered_app_rows:
+						conn.execute(discovered_apps.insert(), discovered_app_rows)
+
+					if dirty_risk_scores:
+						device_ids = [{"b_device_id": device_id} for device_id in dirty_risk_scores]
+						conn.execute(risk_scores.delete().where(risk_scores.columns.device_id == bindparam("b_device_id")), device_ids)
+					if risk_score_rows:
+						conn.execute(risk_scores.insert(), risk_score_rows)
+
+					# Importer state is written in the same transaction as the devices it describes
+					if importer_state_rows:
+						conn.execute(
+							importer_states.delete().where(importer_states.columns.importer == bindparam("b_importer")),
+							[{"b_importer": row["importer"]} for row in importer_state_rows]
+						)
+						conn.execute(importer_states.insert(), importer_state_rows)
+			except:
+				# Try again during the next flush
+				with self.lock:
+					self.dirty_devices |= dirty_devices
+					self.dirty_risk_scores |= dirty_risk_scores
+					self.dirty_importer_states |= dirty_importer_states
+				raise
+
+			logger.info(f"Saved {len(device_rows)} devices and {len(risk_score_rows)} risk scores to database")
 
 	def __exit__(self, *args):
-		# Devices are always deleted and recreated with INSERT
-		self.conn.execute(devices.delete())
-
-		for device in self.devices.values():
-			self.conn.execute(devices.insert().values(
-				id = device.id,
-				name = device.name,
-				os = device.os,
-				ownership = device.ownership,
-			))
-
-			# Save discovered apps if applicable
-			self.conn.execute(discovered_apps.delete().where(discovered_apps.columns.device_id == device.id))
-			for app in device.discovered_apps:
-				self.conn.execute(discovered_apps.insert().values(device_id = device.id, app_id = app))
-
-			# Risk scores are always deleted and recreated with INSERT
-			self.conn.execute(risk_scores.delete().where(risk_scores.columns.device_id == device.id))
-
-			if device.id in self.risk_scores:
-				# Save the combined score
-				self.conn.execute(risk_scores.insert().values(
-					device_id = device.id,
-					combined_value = self.risk_scores[device.id]
-				))
-
-		self.conn.commit()
-		logger.success(f"Saved {len(self.devices)} devices to database")
+		# Only changes that haven't been written by the flusher thread remain
+		self.flush()
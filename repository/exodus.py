@@ -0,0 +1,124 @@
+# Copyright (c) 2024 Hannes Mann, Alexander Wigren
+# See LICENSE for details
+
+from datetime import datetime
+from loguru import logger
+from sqlalchemy import *
+from threading import Lock
+
+metadata = MetaData()
+
+# Define tables for a local copy of Exodus Privacy reports and trackers
+reports = Table(
+	"exodus_reports",
+	metadata,
+
+	# Android package name
+	Column("handle", String(255), primary_key=True),
+	# Value of report_updated_at in /api/applications when the report was downloaded
+	Column("report_updated_at", Double),
+
+	# Most recent report for the package, all NULL if Exodus Privacy has not analyzed the package
+	Column("app_name", String(255)),
+	Column("version_code", BigInteger),
+	Column("version_name", String(255)),
+	Column("permissions", JSON),
+	Column("trackers", JSON),
+
+	Column("synced_at", DateTime)
+)
+trackers = Table(
+	"exodus_trackers",
+	metadata,
+
+	Column("id", String(32), primary_key=True),
+	# Tracker as returned by /api/trackers
+	Column("data", JSON)
+)
+
+def latest_report(reports):
+	"""
+	Returns the most recent report from /api/search/{handle}/details, or None if there are no reports
+
+	The reports are unordered so we need to iterate over them to find the most recent version. The bigger the versionCode, the more recent it is.
+	Note that the versionCode and versionName are different. The code is just an integer, while the name is the true versions like "460.0.0.34.89" as an example.
+	"""
+
+	latest = None
+	for report in reports:
+		if latest is None or int(report["version_code"]) > int(latest["version_code"]):
+			latest = report
+	return latest
+
+class ExodusRepository:
+	"""
+	Local mirror of Exodus Privacy reports for the apps in ApplicationRepository and of the tracker catalog
+	The mirror is kept up to date by importers.apps.exodus.ExodusMirrorThread
+	"""
+
+	def __init__(self, engine):
+		"""
+		:param engine: SQLAlchemy engine, a pooled connection is checked out for each unit of work
+		"""
+		self.engine = engine
+
+		# The tracker catalog is small and read by every tracker report, so it is kept in memory
+		self.tracker_catalog = None
+		self.lock = Lock()
+
+	def report(self, handle):
+		"""Returns the mirrored report row for a package, or None if the package has not been mirrored yet"""
+
+		with self.engine.begin() as conn:
+			return conn.execute(reports.select().where(reports.columns.handle == handle)).first()
+
+	def report_versions(self):
+		"""Returns a dictionary of package name to report_updated_at for all mirrored packages"""
+
+		with self.engine.begin() as conn:
+			return {row.handle: row.report_updated_at for row in conn.execute(select(reports.columns.handle, reports.columns.report_updated_at))}
+
+	def store_report(self, handle, report_updated_at, report):
+		"""
+		:param report_updated_at: Value from /api/applications, or None if unknown
+		:param report: Most recent report from /api/search/{handle}/details, or None if the package has not been analyzed
+		"""
+
+		values = dict(
+			report_updated_at = report_updated_at,
+			app_name = report["app_name"] if report else None,
+			version_code = int(report["version_code"]) if report else None,
+			version_name = report["version_name"] if report else None,
+			permissions = report["permissions"] if report else None,
+			trackers = report["trackers"] if report else None,
+			synced_at = datetime.now()
+		)
+
+		with self.engine.begin() as conn:
+			updated = conn.execute(reports.update().where(reports.columns.handle == handle).values(**values))
+			if updated.rowcount == 0:
+				conn.execute(reports.insert().values(handle = handle, **values))
+
+	def trackers(self):
+		"""Returns a dictionary of tracker ID to tracker, in the same format as /api/trackers"""
+
+		with self.lock:
+			if self.tracker_catalog is None:
+				with self.engine.begin() as conn:
+					self.tracker_catalog = {row.id: row.data for row in conn.execute(trackers.select())}
+			return self.tracker_catalog
+
+	def replace_trackers(self, tracker_catalog):
+		"""
+		:param tracker_catalog: Dictionary of tracker ID to tracker from /api/trackers
+		"""
+
+		with self.engine.begin() as conn:
+			conn.execute(trackers.delete())
+			if tracker_catalog:
+				conn.execute(trackers.insert(), [{"id": str(id), "data": data} for id, data in tracker_catalog.items()])
+
+		with self.lock:
+			self.tracker_catalog = {str(id): data for id, data in tracker_catalog.items()}
+
+		logger.info(f"Mirrored {len(tracker_catalog)} trackers from Exodus Privacy")
@@ -0,0 +1,66 @@
+# Copyright (c) 2024 Hannes Mann, Alexander Wigren
+# See LICENSE for details
+
+from enum import Enum
+from loguru import logger
+from queue import Queue
+from threading import Thread, Timer
+
+import configs
+import traceback
+
+class ThreadEventType(Enum):
+	STOP_THREAD = 0
+	FLUSH_REPOSITORIES = 1
+
+class ThreadEvent:
+	def __init__(self, type, data=None):
+		self.type = type
+		self.data = data
+
+class RepositoryFlusherThread:
+	"""Periodically writes changes in repositories to the database (write-behind)"""
+
+	def __init__(self, repositories):
+		"""
+		:param repositories: Repositories implementing flush()
+		"""
+		self.repositories = repositories
+
+		self.events = Queue()
+		self.schedule_flush()
+
+		self.thread = Thread(target=self.flush_thread, daemon=True)
+		self.thread.start()
+
+	def schedule_flush(self):
+		next_flush_timer = Timer(configs.main.server.flush_timer, lambda:
+			self.events.put(ThreadEvent(ThreadEventType.FLUSH_REPOSITORIES)))
+		next_flush_timer.daemon = True
+		next_flush_timer.start()
+
+	def stop(self):
+		self.events.put(ThreadEvent(ThreadEventType.STOP_THREAD))
+		self.thread.join()
+
+	# Thread to periodically save changes in repositories
+	def flush_thread(self):
+		logger.success(f"Repository flusher thread started and waiting for events")
+
+		while True:
+			event = self.events.get()
+
+			if event.type == ThreadEventType.FLUSH_REPOSITORIES:
+				for repository in self.repositories:
+					try:
+						repository.flush()
+					except Exception as e:
+						if configs.main.server.debug:
+							logger.warning(f"Flushing {type(repository).__name__} failed: {traceback.format_exc()}")
+						else:
+							logger.warning(f"Flushing {type(repository).__name__} failed: {e}")
+
+				self.schedule_flush()
+
+			elif event.type == ThreadEventType.STOP_THREAD:
+				return
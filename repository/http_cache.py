@@ -0,0 +1,144 @@
+# Copyright (c) 2024 Hannes Mann, Alexander Wigren
+# See LICENSE for details
+
+from datetime import datetime, timedelta
+from loguru import logger
+from requests import Response
+from requests.structures import CaseInsensitiveDict
+from sqlalchemy import *
+from threading import Lock
+
+import configs
+
+metadata = MetaData()
+
+# Define table for cached responses
+responses = Table(
+	"http_cache_responses",
+	metadata,
+
+	Column("url", String(2048), primary_key=True),
+	Column("final_url", String(2048)),
+	Column("status_code", Integer),
+	Column("encoding", String(64)),
+	Column("content_type", String(255)),
+	Column("etag", String(255)),
+	Column("last_modified", String(64)),
+	Column("content", LargeBinary),
+	Column("size", Integer),
+	# Time of the last download or successful revalidation
+	Column("validated_at", DateTime),
+	# Used for least recently used eviction
+	Column("accessed_at", DateTime, index=True)
+)
+
+class HttpCache:
+	"""
+	Caches successful GET responses in the database
+
+	Responses are fresh for the time-to-live configured for the host in configs.main.network.cache.ttls.
+	After that, the request is sent with If-None-Match/If-Modified-Since and a 304 response reuses the cached
+	content. The least recently used responses are evicted when the cache grows larger than max_size_mb.
+	"""
+
+	def __init__(self, engine):
+		"""
+		:param engine: SQLAlchemy engine, a pooled connection is checked out for each unit of work
+		"""
+		self.engine = engine
+		# Prevents concurrent evictions from deleting more than needed
+		self.eviction_lock = Lock()
+
+	def ttl_for_host(self, host):
+		ttls = configs.main.network.cache.ttls
+		return timedelta(seconds=ttls.get(host, ttls.default))
+
+	def get(self, url):
+		"""Returns the cached row for url, or None"""
+
+		with self.engine.begin() as conn:
+			row = conn.execute(responses.select().where(responses.columns.url == url)).first()
+			if row:
+				conn.execute(responses.update().where(responses.columns.url == url).values(accessed_at = datetime.now()))
+			return row
+
+	def is_fresh(self, row, host):
+		return datetime.now() - row.validated_at < self.ttl_for_host(host)
+
+	def revalidation_headers(self, row):
+		"""Headers for a conditional request that returns 304 if the cached response is still valid"""
+
+		headers = {}
+		if row.etag:
+			headers["If-None-Match"] = row.etag
+		if row.last_modified:
+			headers["If-Modified-Since"] = row.last_modified
+		return headers
+
+	def mark_validated(self, url):
+		with self.engine.begin() as conn:
+			conn.execute(responses.update().where(responses.columns.url == url).values(validated_at = datetime.now()))
+
+	def put(self, url, res):
+		"""Store a successful response for url"""
+
+		content = res.content
+		if len(content) > configs.main.network.cache.max_size_mb * 1024 * 1024:
+			return
+
+		values = dict(
+			final_url = res.url,
+			status_code = res.status_code,
+			encoding = res.encoding,
+			content_type = res.headers.get("Content-Type"),
+			etag = res.headers.get("ETag"),
+			last_modified = res.headers.get("Last-Modified"),
+			content = content,
+			size = len(content),
+			validated_at = datetime.now(),
+			accessed_at = datetime.now()
+		)
+
+		with self.engine.begin() as conn:
+			updated = conn.execute(responses.update().where(responses.columns.url == url).values(**values))
+			if updated.rowcount == 0:
+				conn.execute(responses.insert().values(url = url, **values))
+
+		self.evict()
+
+	def evict(self):
+		"""Delete least recently used responses until the cache fits in max_size_mb"""
+
+		max_size = configs.main.network.cache.max_size_mb * 1024 * 1024
+		with self.eviction_lock, self.engine.begin() as conn:
+			total_size = conn.execute(select(func.coalesce(func.sum(responses.columns.size), 0))).scalar()
+			if total_size <= max_size:
+				return
+
+			evicted_urls = []
+			for row in conn.execute(select(responses.columns.url, responses.columns.size).order_by(responses.columns.accessed_at)):
+				if total_size <= max_size:
+					break
+				evicted_urls.append({"b_url": row.url})
+				total_size -= row.size
+
+			conn.execute(responses.delete().where(responses.columns.url == bindparam("b_url")), evicted_urls)
+
+		logger.info(f"Evicted {len(evicted_urls)} responses from HTTP cache")
+
+	def to_response(self, row):
+		"""Recreate a requests.Response from a cached row"""
+
+		res = Response()
+		res.status_code = row.status_code
+		res.url = row.final_url
+		res.encoding = row.encoding
+		res._content = row.content
+		res.headers = CaseInsensitiveDict()
+		if row.content_type:
+			res.headers["Content-Type"] = row.content_type
+		if row.etag:
+			res.headers["ETag"] = row.etag
+		if row.last_modified:
+			res.headers["Last-Modified"] = row.last_modified
+		return res
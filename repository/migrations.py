@@ -0,0 +1,98 @@
+# Copyright (c) 2024 Hannes Mann, Alexander Wigren
+# See LICENSE for details
+
+from datetime import datetime
+from loguru import logger
+from sqlalchemy import *
+
+import repository.apps as apps_repository
+import repository.devices as devices_repository
+import repository.exodus as exodus_repository
+import repository.http_cache as http_cache
+import repository.token_cache as token_cache
+
+metadata = MetaData()
+
+# Define table for storing which migrations have been applied to the database
+schema_versions = Table(
+	"schema_versions",
+	metadata,
+
+	Column("version", Integer, primary_key=True),
+	Column("description", String(255)),
+	Column("applied_at", DateTime)
+)
+
+# Migrations should only use plain SQL or their own table definitions,
+# since tables in the repositories describe the latest version of the schema
+
+def add_lookup_indexes(conn):
+	"""Add indexes for columns used to look up permissions, trackers, discovered apps and risk scores"""
+
+	for table, column in (
+		("android_permissions", "app_id"),
+		("android_trackers", "app_id"),
+		("device_discovered_apps", "device_id"),
+		("device_discovered_apps", "app_id"),
+		("device_risk_scores", "device_id"),
+	):
+		conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{table}_{column} ON {table} ({column})"))
+
+def normalize_permissions_and_trackers(conn):
+	"""Move permission and tracker names to dictionary tables referenced by integer IDs"""
+
+	for kind in ("permission", "tracker"):
+		# android_permissions => android_permission_names + android_app_permissions
+		conn.execute(text(
+			f"INSERT INTO android_{kind}_names (name) SELECT DISTINCT {kind} FROM android_{kind}s WHERE {kind} IS NOT NULL"
+		))
+		conn.execute(text(
+			f"INSERT INTO android_app_{kind}s (app_id, {kind}_id) "
+			f"SELECT old.app_id, names.id FROM android_{kind}s old JOIN android_{kind}_names names ON names.name = old.{kind}"
+		))
+		conn.execute(text(f"DROP TABLE android_{kind}s"))
+
+def add_install_counts(conn):
+	"""Add install counts from device importers to apps"""
+
+	conn.execute(text("ALTER TABLE apps ADD COLUMN install_count INTEGER"))
+
+# Migrations are applied in order to databases that were created before the migration was added
+# A migration that has been released should never be changed, add a new migration instead
+migrations = (
+	(1, add_lookup_indexes),
+	(2, normalize_permissions_and_trackers),
+	(3, add_install_counts),
+)
+
+def migrate_database(engine):
+	"""
+	Create missing tables and upgrade existing databases to the latest schema
+
+	:param engine: SQLAlchemy engine
+	"""
+
+	with engine.begin() as conn:
+		# A database without apps has never been opened by the server and gets the latest schema directly
+		new_database = not inspect(conn).has_table(apps_repository.apps.name)
+
+		for table_metadata in (metadata, apps_repository.metadata, devices_repository.metadata, exodus_repository.metadata, http_cache.metadata, token_cache.metadata):
+			table_metadata.create_all(conn)
+
+		current_version = conn.execute(select(func.max(schema_versions.columns.version))).scalar() or 0
+
+		for version, upgrade in migrations:
+			if version <= current_version:
+				continue
+
+			if not new_database:
+				logger.info(f"Upgrading database to version {version}: {upgrade.__doc__}")
+				upgrade(conn)
+
+			conn.execute(schema_versions.insert().values(
+				version = version,
+				description = upgrade.__doc__,
+				applied_at = datetime.now()
+			))
+
+	logger.success(f"Database schema is at version {migrations[-1][0]}")
@@ -0,0 +1,90 @@
+# Copyright (c) 2024 Hannes Mann, Alexander Wigren
+# See LICENSE for details
+
+from Crypto.Cipher import AES
+from Crypto.Hash import SHA256
+from Crypto.Protocol.KDF import PBKDF2
+from Crypto.Random import get_random_bytes
+from datetime import datetime
+from loguru import logger
+from sqlalchemy import *
+
+import msal
+
+metadata = MetaData()
+
+# Define table for encrypted MSAL token caches
+token_caches = Table(
+	"msal_token_caches",
+	metadata,
+
+	Column("name", String(255), primary_key=True),
+	# Salt for deriving the encryption key from the client secret
+	Column("salt", LargeBinary),
+	# AES-GCM nonce and authentication tag
+	Column("nonce", LargeBinary),
+	Column("tag", LargeBinary),
+	Column("ciphertext", LargeBinary),
+	Column("updated_at", DateTime)
+)
+
+def encryption_key(secret, salt):
+	"""Derive a 256-bit AES key from a client secret"""
+	return PBKDF2(secret, salt, dkLen=32, count=100000, hmac_hash_module=SHA256)
+
+class TokenCacheRepository:
+	"""
+	Stores msal.SerializableTokenCache in the database, encrypted with AES-GCM
+
+	The key is derived from the client secret of the application that owns the cache, so a database
+	without secrets.toml can't be used to read the tokens. Caches that can't be decrypted, for example
+	after the secret has been rotated, are discarded and a new token is requested.
+	"""
+
+	def __init__(self, engine):
+		"""
+		:param engine: SQLAlchemy engine, a pooled connection is checked out for each unit of work
+		"""
+		self.engine = engine
+
+	def load(self, name, secret):
+		"""Returns the saved token cache for name, or an empty cache"""
+
+		cache = msal.SerializableTokenCache()
+
+		with self.engine.begin() as conn:
+			row = conn.execute(token_caches.select().where(token_caches.columns.name == name)).first()
+
+		if row:
+			try:
+				cipher = AES.new(encryption_key(secret, row.salt), AES.MODE_GCM, nonce=row.nonce)
+				cache.deserialize(cipher.decrypt_and_verify(row.ciphertext, row.tag).decode("utf-8"))
+			except ValueError:
+				logger.warning(f"Could not decrypt token cache for {name}, a new token will be requested")
+
+		return cache
+
+	def save(self, name, secret, cache):
+		"""Encrypt and store cache if it has changed since it was loaded or last saved"""
+
+		if not cache.has_state_changed:
+			return
+
+		salt = get_random_bytes(16)
+		cipher = AES.new(encryption_key(secret, salt), AES.MODE_GCM)
+		ciphertext, tag = cipher.encrypt_and_digest(cache.serialize().encode("utf-8"))
+
+		values = dict(
+			salt = salt,
+			nonce = cipher.nonce,
+			tag = tag,
+			ciphertext = ciphertext,
+			updated_at = datetime.now()
+		)
+
+		with self.engine.begin() as conn:
+			updated = conn.execute(token_caches.update().where(token_caches.columns.name == name).values(**values))
+			if updated.rowcount == 0:
+				conn.execute(token_caches.insert().values(name = name, **values))
+
+		cache.has_state_changed = False
@@ -0,0 +1,167 @@
+# Copyright (c) 2024 Hannes Mann, Alexander Wigren
+# See LICENSE for details
+
+from loguru import logger
+
+# NumPy is optional and only needed when configs.main.analysis.risk_score_engine is set to "numpy"
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+class VectorizedRiskEngine:
+	"""
+	Computes device and organization risk scores with NumPy array operations
+
+	Devices are stored as a CSR (compressed sparse row) incidence matrix where each row is a device
+	and each column is an app. Scores for every device are computed from the matrix and a vector of
+	app scores in a few array operations instead of one Python loop per device.
+	"""
+
+	def __init__(self):
+		# Column for each app unique ID
+		self.app_columns = {}
+		# Device ID for each row
+		self.device_ids = []
+
+		# CSR structure: apps for row i are indices[indptr[i]:indptr[i + 1]]
+		self.indptr = np.zeros(1, dtype=np.int64)
+		self.indices = np.zeros(0, dtype=np.int64)
+		# Row for each stored element, used for grouping
+		self.rows = np.zeros(0, dtype=np.int64)
+
+	def rebuild(self, devices):
+		"""
+		:param devices: Dictionary of device ID to model.Device
+		"""
+
+		self.app_columns = {}
+		self.device_ids = list(devices.keys())
+
+		indptr = [0]
+		indices = []
+		for device in devices.values():
+			for app in device.discovered_app_unique_ids():
+				indices.append(self.app_columns.setdefault(app, len(self.app_columns)))
+			indptr.append(len(indices))
+
+		self.indptr = np.array(indptr, dtype=np.int64)
+		self.indices = np.array(indices, dtype=np.int64)
+		self.rows = np.repeat(np.arange(len(self.device_ids), dtype=np.int64), np.diff(self.indptr))
+
+		logger.info(f"Built incidence matrix for {len(self.device_ids)} devices and {len(self.app_columns)} apps ({len(self.indices)} installs)")
+
+	def app_score_vectors(self, risk_scores):
+		"""
+		:param risk_scores: Dictionary of app unique ID to ApplicationRiskScore
+		:returns: Score and weight for each column, NaN for apps without a risk score
+		"""
+
+		scores = np.full(len(self.app_columns), np.nan)
+		weights = np.zeros(len(self.app_columns))
+		for app, column in self.app_columns.items():
+			risk_score = risk_scores.get(app)
+			if risk_score and risk_score.overall_score is not None:
+				scores[column] = risk_score.overall_score
+				# Apps are weighted by the number of analyzers that contributed to their risk score
+				weights[column] = len(risk_score.sources)
+		return scores, weights
+
+	def device_scores(self, risk_scores, method):
+		"""
+		:param risk_scores: Dictionary of app unique ID to ApplicationRiskScore
+		:param method: Value of configs.main.analysis.risk_score_method_device
+		:returns: Dictionaries of device ID to combined score and device ID to number of analyzed apps
+		"""
+
+		scores, weights = self.app_score_vectors(risk_scores)
+		values = scores[self.indices]
+		analyzed = ~np.isnan(values)
+
+		combined, counts = aggregate_groups(
+			self.rows[analyzed],
+			values[analyzed],
+			weights[self.indices][analyzed],
+			len(self.device_ids),
+			method
+		)
+
+		scored = np.flatnonzero(counts > 0)
+		return (
+			{self.device_ids[i]: float(combined[i]) for i in scored},
+			{self.device_ids[i]: int(counts[i]) for i in scored}
+		)
+
+	def organization_scores(self, devices, device_scores, analyzed_app_counts, groups_for_device, method):
+		"""
+		:param devices: Devices with a risk score
+		:param device_scores: Dictionary of device ID to risk score
+		:param analyzed_app_counts: Dictionary of device ID to number of analyzed apps, used as weight
+		:param groups_for_device: Function that returns the groups a device contributes to
+		:param method: Value of configs.main.analysis.risk_score_method_organization
+		:returns: Dictionary of group to combined score
+		"""
+
+		group_indices = {}
+		groups = []
+		values = []
+		weights = []
+		for device in devices:
+			for group in groups_for_device(device):
+				groups.append(group_indices.setdefault(group, len(group_indices)))
+				values.append(device_scores[device.id])
+				weights.append(analyzed_app_counts.get(device.id, 1))
+
+		combined, _ = aggregate_groups(
+			np.array(groups, dtype=np.int64),
+			np.array(values, dtype=np.float64),
+			np.array(weights, dtype=np.float64),
+			len(group_indices),
+			method
+		)
+		return {group: float(combined[i]) for group, i in group_indices.items()}
+
+def aggregate_groups(groups, values, weights, group_count, method):
+	"""
+	Combine values for each group with the same semantics as repository.aggregators
+
+	:returns: Combined value and number of values for each group
+	"""
+
+	counts = np.bincount(groups, minlength=group_count)
+	combined = np.zeros(group_count)
+
+	if method in ("avg", "weighted"):
+		if method == "avg":
+			weights = np.ones(len(values))
+		totals = np.bincount(groups, weights=values * weights, minlength=group_count)
+		total_weights = np.bincount(groups, weights=weights, minlength=group_count)
+		np.divide(totals, total_weights, out=combined, where=total_weights > 0)
+	elif method in ("max", "p90"):
+		percentile = 100 if method == "max" else 90
+
+		# Sort values within each group and pick the nearest-rank percentile
+		sorted_values = values[np.lexsort((values, groups))]
+		starts = np.cumsum(counts) - counts
+		ranks = np.maximum(np.ceil(counts * percentile / 100).astype(np.int64) - 1, 0)
+		has_values = counts > 0
+		combined[has_values] = sorted_values[starts[has_values] + ranks[has_values]]
+	else:
+		raise ValueError(f"Invalid risk score method: {method}")
+
+	return combined, counts
+
+def create_vectorized_engine(name):
+	"""
+	:param name: Value of configs.main.analysis.risk_score_engine
+	:returns: VectorizedRiskEngine, or None if device scores should be computed in Python
+	"""
+
+	if name == "python":
+		return None
+	elif name == "numpy":
+		if np is None:
+			logger.warning("configs.main.analysis.risk_score_engine is set to numpy but NumPy is not installed. Falling back to Python.")
+			return None
+		return VectorizedRiskEngine()
+	raise ValueError("Invalid configs.main.analysis.risk_score_engine")
@@ -0,0 +1,21 @@
+# Copyright (c) 2024 Hannes Mann, Alexander Wigren
+# See LICENSE for details
+
+from loguru import logger
+from os import path
+
+import pytest
+import sys
+
+# Modules are imported from the root of the repository, the same way main.py imports them
+root = path.dirname(path.dirname(path.abspath(__file__)))
+sys.path.insert(0, root)
+
+import configs
+
+@pytest.fixture(autouse=True)
+def default_configs():
+	"""Load config.toml and secrets.toml before each test, so changes made by a test don't leak into the next"""
+	logger.remove()
+	configs.load(path.join(root, "config.toml"), path.join(root, "secrets.toml"))
+	yield configs.main
@@ -0,0 +1,76 @@
+# Copyright (c) 2024 Hannes Mann, Alexander Wigren
+# See LICENSE for details
+
+from munch import Munch
+
+import datetime
+import importers.devices.intune as intune
+import network
+
+class Response:
+	def __init__(self, status_code, body=None):
+		self.status_code = status_code
+		self.body = body
+		self.headers = {}
+
+	def json(self):
+		return self.body
+
+	def raise_for_status(self):
+		if self.status_code >= 400:
+			raise Exception(f"HTTP {self.status_code}")
+
+def create_importer(monkeypatch, responses):
+	"""Returns an importer that gets a new token for every connect, and the tokens that were sent with each request"""
+
+	importer = intune.IntuneImporter()
+	sent_tokens = []
+
+	def connect():
+		importer.token = f"token{len(sent_tokens)}"
+		importer.token_expires_at = datetime.datetime.now() + datetime.timedelta(hours=1)
+
+	def request(method, url, headers, **kwargs):
+		sent_tokens.append(headers["Authorization"].removeprefix("Bearer "))
+		return responses.pop(0)
+
+	monkeypatch.setattr(importer, "connect", connect)
+	monkeypatch.setattr(network, "request", request)
+	monkeypatch.setattr(intune, "wait_for_host", lambda url, requests=1: None)
+	importer.connect()
+	return importer, sent_tokens
+
+def page(value, next_link=None):
+	return Response(200, {"value": value, "@odata.nextLink": next_link})
+
+def test_token_is_refreshed_between_pages(monkeypatch):
+	importer, sent_tokens = create_importer(monkeypatch, [page([1], f"{intune.graph_url}/next"), page([2])])
+
+	items = importer.intune_items("items")
+	assert next(items) == 1
+	# The token expires while the first page is being processed
+	importer.token_expires_at = datetime.datetime.now()
+	assert list(items) == [2]
+	assert sent_tokens == ["token0", "token1"]
+
+def test_rejected_token_is_renewed_once(monkeypatch):
+	importer, sent_tokens = create_importer(monkeypatch, [Response(401), Response(200, {"responses": [
+		{"id": "0", "status": 200, "body": {"value": [1]}}
+	]})])
+
+	assert importer.send_batch(["items"]) == {"items": [1]}
+	assert sent_tokens == ["token0", "token1"]
+
+	# A second 401 with the new token is returned to the caller
+	importer, sent_tokens = create_importer(monkeypatch, [Response(401), Response(401)])
+	assert importer.graph_request("GET", f"{intune.graph_url}/items").status_code == 401
+	assert len(sent_tokens) == 2
+
+def test_detected_app_ids_are_fixed_up_on_devices(monkeypatch):
+	devices = page([{"id": "device", "operatingSystem": "Android", "deviceName": "Device", "managedDeviceOwnerType": "company"}])
+	detected_apps = Response(200, {"responses": [
+		{"id": "0", "status": 200, "body": {"value": [{"displayName": "com.example. "}, {"displayName": "com.example"}]}}
+	]})
+	importer, _ = create_importer(monkeypatch, [devices, detected_apps])
+
+	assert importer.fetch_devices()["device"].discovered_apps == ["com.example"]
@@ -0,0 +1,26 @@
+# Copyright (c) 2024 Hannes Mann, Alexander Wigren
+# See LICENSE for details
+
+from model.app import Application, OperatingSystem
+from model.mdm import Device, DeviceOwnership
+
+def test_discovered_apps_keep_order_and_skip_duplicates():
+	device = Device("device", "Device", OperatingSystem.ANDROID, DeviceOwnership.CORPORATE_OWNED)
+	device.update_discovered_apps(["com.b", "com.a", "com.b", Application("com.c", OperatingSystem.ANDROID)])
+	assert device.discovered_apps == ["com.b", "com.a", "com.c"]
+
+	device.update_discovered_apps(["com.a", "com.d"], replace=False)
+	assert device.discovered_apps == ["com.b", "com.a", "com.c", "com.d"]
+
+def test_is_app_installed_after_apps_change():
+	device = Device("device", "Device", OperatingSystem.ANDROID, DeviceOwnership.CORPORATE_OWNED)
+	device.update_discovered_apps(["com.b", "com.a"])
+	assert device.is_app_installed("com.a")
+	assert not device.is_app_installed("com.c")
+	assert not device.is_app_installed("com.never.seen")
+
+	# The sorted copy made by the first lookup must not be used for the new apps
+	device.update_discovered_apps(["com.c"], replace=False)
+	assert device.is_app_installed("com.c")
+	device.update_discovered_apps(["com.c"])
+	assert not device.is_app_installed("com.a")
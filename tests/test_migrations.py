@@ -0,0 +1,78 @@
+# Copyright (c) 2024 Hannes Mann, Alexander Wigren
+# See LICENSE for details
+
+from repository.migrations import migrate_database, migrations, schema_versions
+from sqlalchemy import create_engine, func, inspect, select, text
+
+import pytest
+
+@pytest.fixture
+def engine(tmp_path):
+	engine = create_engine(f"sqlite:///{tmp_path / 'test.db'}")
+	yield engine
+	engine.dispose()
+
+def query_plan(conn, query):
+	return " ".join(row[-1] for row in conn.execute(text(f"EXPLAIN QUERY PLAN {query}")))
+
+@pytest.mark.parametrize("query", (
+	"SELECT permission_id FROM android_app_permissions WHERE app_id = 'com.example'",
+	"SELECT tracker_id FROM android_app_trackers WHERE app_id = 'com.example'",
+	"SELECT value FROM detailed_app_risk_scores WHERE app_unique_id = 'com.example_ANDROID'",
+	"SELECT app_id FROM device_discovered_apps WHERE device_id = 'device'",
+	"SELECT device_id FROM device_discovered_apps WHERE app_id = 'com.example'",
+	"SELECT combined_value FROM device_risk_scores WHERE device_id = 'device'",
+))
+def test_lookups_use_indexes(engine, query):
+	migrate_database(engine)
+	with engine.connect() as conn:
+		plan = query_plan(conn, query)
+	assert "SEARCH" in plan and "INDEX" in plan, plan
+
+def test_primary_keys_are_not_indexed_again(engine):
+	migrate_database(engine)
+	with engine.connect() as conn:
+		# app_unique_id is the first column of the primary key, which SQLite already indexes
+		assert inspect(conn).get_indexes("detailed_app_risk_scores") == []
+
+def test_old_database_is_upgraded_in_place(engine):
+	# Schema and data from before versioned migrations were added
+	with engine.begin() as conn:
+		for statement in (
+			"CREATE TABLE apps (id VARCHAR(255), os VARCHAR(7), name VARCHAR(255), store_page_url VARCHAR(255), "
+			"privacy_policy_url VARCHAR(255), other_os_id VARCHAR(255), PRIMARY KEY (id, os))",
+			"CREATE TABLE android_permissions (app_id VARCHAR(255), permission VARCHAR(128), UNIQUE (app_id, permission))",
+			"CREATE TABLE android_trackers (app_id VARCHAR(255), tracker VARCHAR(128), UNIQUE (app_id, tracker))",
+			"CREATE TABLE app_risk_scores (app_unique_id VARCHAR(255) PRIMARY KEY, overall_value FLOAT, method VARCHAR(32))",
+			"CREATE TABLE detailed_app_risk_scores (app_unique_id VARCHAR(255), analyzer VARCHAR(255), value FLOAT, "
+			"PRIMARY KEY (app_unique_id, analyzer))",
+			"CREATE TABLE devices (id VARCHAR(255) PRIMARY KEY, name VARCHAR(255), os VARCHAR(7), ownership VARCHAR(15))",
+			"CREATE TABLE device_discovered_apps (device_id VARCHAR(255), app_id VARCHAR(255), UNIQUE (device_id, app_id))",
+			"CREATE TABLE device_risk_scores (device_id VARCHAR(255), combined_value FLOAT)",
+			"INSERT INTO apps (id, os) VALUES ('com.example', 'ANDROID')",
+			"INSERT INTO android_permissions VALUES ('com.example', 'android.permission.CAMERA')",
+			"INSERT INTO android_trackers VALUES ('com.example', '27')",
+		):
+			conn.execute(text(statement))
+
+	migrate_database(engine)
+
+	with engine.connect() as conn:
+		assert conn.execute(select(func.max(schema_versions.columns.version))).scalar() == migrations[-1][0]
+		assert "install_count" in {column["name"] for column in inspect(conn).get_columns("apps")}
+		assert not inspect(conn).has_table("android_permissions")
+		assert conn.execute(text(
+			"SELECT names.name FROM android_app_permissions permissions "
+			"JOIN android_permission_names names ON names.id = permissions.permission_id WHERE permissions.app_id = 'com.example'"
+		)).scalar() == "android.permission.CAMERA"
+		assert conn.execute(text(
+			"SELECT names.name FROM android_app_trackers trackers "
+			"JOIN android_tracker_names names ON names.id = trackers.tracker_id WHERE trackers.app_id = 'com.example'"
+		)).scalar() == "27"
+
+		plan = query_plan(conn, "SELECT app_id FROM device_discovered_apps WHERE device_id = 'device'")
+		assert "INDEX" in plan, plan
+		assert inspect(conn).get_indexes("detailed_app_risk_scores") == []
+
+	# Running the migrations again does nothing
+	migrate_database(engine)
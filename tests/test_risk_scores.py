@@ -0,0 +1,34 @@
+# Copyright (c) 2024 Hannes Mann, Alexander Wigren
+# See LICENSE for details
+
+from model.app import Application, OperatingSystem
+from repository.apps import ApplicationRepository
+
+import configs
+
+def test_sources_with_zero_weight_give_no_score():
+	configs.main.analysis.risk_score_method_app = "weighted"
+	configs.main.analysis.weights = {"Android Permissions": 0.0}
+	repo = ApplicationRepository(None)
+	app = Application("app", OperatingSystem.ANDROID)
+
+	assert not repo.update_risk_score_from_sources(app, {"Android Permissions": 0.5})
+	assert repo.risk_score(app.unique_id()) is None
+
+	# A source with a weight gives a score again
+	assert repo.update_risk_score_from_sources(app, {"Android Permissions": 0.5, "Exodus": 1.0})
+	assert repo.risk_score(app.unique_id()).overall_score == 1.0
+
+def test_snapshot_only_changes_when_published():
+	repo = ApplicationRepository(None)
+	app = Application("app", OperatingSystem.ANDROID)
+	repo.add_or_update_app(app)
+	assert len(repo.snapshot().apps) == 0
+
+	repo.publish()
+	snapshot = repo.snapshot()
+	assert list(snapshot.apps) == [app.unique_id()]
+
+	# Nothing has changed, so the same snapshot is kept
+	repo.publish()
+	assert repo.snapshot() is snapshot
@@ -0,0 +1,94 @@
+# Copyright (c) 2024 Hannes Mann, Alexander Wigren
+# See LICENSE for details
+
+from model.app import Application, OperatingSystem
+from model.mdm import Device, DeviceOwnership
+from repository.aggregators import risk_score_methods
+from repository.apps import ApplicationRepository, ApplicationRiskScore
+from repository.devices import DevicesRepository
+
+import configs
+import pytest
+import random
+
+pytest.importorskip("numpy")
+
+def create_app_repository(app_count):
+	repo = ApplicationRepository(None)
+	rng = random.Random(1)
+	for i in range(app_count):
+		# Some apps have not been analyzed yet, and some scores are repeated
+		if rng.random() < 0.7:
+			score = rng.choice([0.0, 0.5, 1.0, rng.random()])
+			sources = {f"analyzer{s}": score for s in range(rng.randrange(1, 4))}
+			repo.risk_scores[Application(f"app{i}", OperatingSystem.ANDROID).unique_id()] = ApplicationRiskScore(score, sources, "max")
+	repo.version += 1
+	repo.publish()
+	return repo
+
+def create_devices_repository(engine, app_count, device_count):
+	configs.main.analysis.risk_score_engine = engine
+	repo = DevicesRepository(None)
+	rng = random.Random(2)
+	for i in range(device_count):
+		device = Device(f"device{i}", f"Device {i}", rng.choice([OperatingSystem.ANDROID, OperatingSystem.IOS]), rng.choice(list(DeviceOwnership)))
+		device.update_discovered_apps(f"app{rng.randrange(app_count)}" for _ in range(rng.randrange(0, 30)))
+		repo.add_or_replace_device(device)
+	return repo
+
+@pytest.mark.parametrize("device_method", risk_score_methods)
+@pytest.mark.parametrize("organization_method", risk_score_methods)
+def test_numpy_engine_matches_python(device_method, organization_method):
+	configs.main.analysis.risk_score_method_device = device_method
+	configs.main.analysis.risk_score_method_organization = organization_method
+	apps = create_app_repository(500)
+
+	results = {}
+	for engine in ("python", "numpy"):
+		devices = create_devices_repository(engine, 500, 1000)
+		devices.update_risk_scores_from_repo(apps)
+		results[engine] = devices
+
+	python, numpy = results["python"], results["numpy"]
+	assert python.risk_scores and python.risk_scores.keys() == numpy.risk_scores.keys()
+	for device_id, score in python.risk_scores.items():
+		assert numpy.risk_scores[device_id] == pytest.approx(score)
+	assert python.analyzed_app_counts == numpy.analyzed_app_counts
+
+	assert numpy.organization_score() == pytest.approx(python.organization_score())
+	for kind in ("os", "ownership"):
+		assert numpy.organization_scores_by(kind) == pytest.approx(python.organization_scores_by(kind))
+
+@pytest.mark.parametrize("device_method", risk_score_methods)
+def test_incremental_update_matches_full_rescore(device_method):
+	configs.main.analysis.risk_score_method_device = device_method
+	apps = create_app_repository(500)
+	devices = create_devices_repository("python", 500, 500)
+	devices.update_risk_scores_from_repo(apps)
+
+	# Change, add and remove some app scores and only pass the apps that the repository reports as changed
+	rng = random.Random(3)
+	changed = set()
+	for i in rng.sample(range(500), 100):
+		app = Application(f"app{i}", OperatingSystem.ANDROID)
+		previous = apps.risk_score(app.unique_id())
+		if rng.random() < 0.2:
+			apps.risk_scores.pop(app.unique_id(), None)
+			apps.version += 1
+			changed.add(app.unique_id())
+			continue
+
+		# Some apps keep their score but get another number of sources, which changes their weight
+		score = previous.overall_score if previous and rng.random() < 0.5 else rng.random()
+		sources = {f"analyzer{s}": score for s in range(rng.randrange(1, 4))}
+		if apps.update_risk_score_from_sources(app, sources):
+			changed.add(app.unique_id())
+	apps.publish()
+
+	devices.update_risk_scores_from_repo(apps, changed)
+	incremental = dict(devices.risk_scores)
+	devices.update_risk_scores_from_repo(apps)
+
+	assert incremental and incremental.keys() == devices.risk_scores.keys()
+	for device_id, score in devices.risk_scores.items():
+		assert incremental[device_id] == pytest.approx(score)